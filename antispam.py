@@ -0,0 +1,99 @@
+'''
+antispam.py tracks how fast each member posts and whether they keep
+posting the same thing, so message floods can be stopped before the
+cogs that react to messages (e.g. levels) do any database work.
+Everything is kept in bounded in-memory structures that expire by themselves.
+'''
+
+import time
+from collections import OrderedDict
+
+RATE = 5            # Messages a member can post...
+PER = 5.0           # ...in this many seconds before they count as spam
+DUPLICATES = 3      # The same message this many times in a row is spam
+EXPIRY = 60.0       # Members idle this long are forgotten
+MAX_TRACKED = 10000 # Most members tracked at once, the least recently seen go first
+VERDICT_CACHE = 256 # Messages whose verdict is remembered for the other listeners
+
+class MemberRate:
+    '''Token bucket and last message hash of one member, a few dozen bytes each'''
+    __slots__ = ('tokens', 'stamp', 'last_hash', 'repeats', 'strikes')
+
+    def __init__(self, now):
+        self.tokens = float(RATE)
+        self.stamp = now
+        self.last_hash = 0
+        self.repeats = 0
+        self.strikes = 0
+
+class SpamFilter:
+    '''
+    Decides whether a message is spam in O(1).
+    The verdict of each message is cached, so the first listener to ask
+    does the work and every other listener gets the same answer.
+    '''
+
+    def __init__(self, rate=RATE, per=PER, duplicates=DUPLICATES, expiry=EXPIRY, max_tracked=MAX_TRACKED):
+        self.rate = rate
+        self.per = per
+        self.duplicates = duplicates
+        self.expiry = expiry
+        self.max_tracked = max_tracked
+        self.members = OrderedDict()    # (guild id, user id) -> MemberRate, least recently seen first
+        self.verdicts = OrderedDict()   # message id -> strikes
+
+    def expire(self, now):
+        '''Drops idle members from the front; each member is dropped once so this is amortised O(1)'''
+        members = self.members
+        while members:
+            key, record = next(iter(members.items()))
+            if now - record.stamp < self.expiry and len(members) <= self.max_tracked:
+                break
+            del members[key]
+
+    def forget_guild(self, guild_id):
+        '''Drops every member tracked in a guild the bot has left'''
+        for key in [key for key in self.members if key[0] == guild_id]:
+            del self.members[key]
+
+    def check(self, message):
+        '''
+        Returns how many spam messages in a row the author has sent, 0 if this one is fine.
+        Direct messages and bots are never counted.
+        '''
+
+        if message.id in self.verdicts:
+            return self.verdicts[message.id]
+        if not message.guild or message.author.bot:
+            return 0
+
+        now = time.monotonic()
+        key = (message.guild.id, message.author.id)
+        record = self.members.pop(key, None) or MemberRate(now)
+        self.members[key] = record  # Moves the member to the most recently seen end
+        self.expire(now)
+
+        # Refills the bucket for the time since the last message, then spends one token
+        record.tokens = min(self.rate, record.tokens + (now - record.stamp) * self.rate / self.per)
+        record.stamp = now
+        flooding = record.tokens < 1
+        if not flooding:
+            record.tokens -= 1
+
+        content_hash = hash(message.content.strip().lower())
+        if content_hash == record.last_hash:
+            record.repeats += 1
+        else:
+            record.last_hash = content_hash
+            record.repeats = 1
+
+        if flooding or record.repeats >= self.duplicates:
+            record.strikes += 1
+        else:
+            record.strikes = 0
+
+        self.verdicts[message.id] = record.strikes
+        if len(self.verdicts) > VERDICT_CACHE:
+            self.verdicts.popitem(last=False)
+        return record.strikes
+
@@ -0,0 +1,80 @@
+'''
+track_memory.py compares the memory a queued song costs with the full youtube_dl
+info dict (what SongInfo used to keep) against the compact music.TrackInfo.
+The info dicts are synthetic but shaped like a processed youtube extraction:
+a few dozen formats with their urls and headers, thumbnails and subtitle maps.
+
+Usage (from the repository root):
+    python benchmarks/track_memory.py --entries 50 --guilds 100
+'''
+
+import argparse
+import os
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from music import TrackInfo     # noqa: E402
+
+def fake_info(rng, video_id):
+    '''An info dict with the fields youtube_dl fills in for one video'''
+    expire = 1700000000 + rng.randrange(10 ** 6)
+    base = f'https://r{rng.randrange(10)}.googlevideo.com/videoplayback?expire={expire}&id={video_id}'
+    formats = [{
+        'format_id': str(format_id),
+        'url': f'{base}&itag={format_id}&sig={rng.getrandbits(256):x}',
+        'ext': rng.choice(['webm', 'm4a', 'mp4']),
+        'acodec': 'opus', 'vcodec': 'none', 'abr': rng.choice([48, 64, 128, 160]),
+        'filesize': rng.randrange(10 ** 7), 'tbr': rng.random() * 200,
+        'http_headers': {'User-Agent': 'Mozilla/5.0', 'Accept': 'text/html', 'Accept-Language': 'en-us'},
+        'downloader_options': {'http_chunk_size': 10485760},
+    } for format_id in range(rng.randint(20, 40))]
+    return {
+        'id': video_id,
+        'title': f'Trending song {video_id}',
+        'uploader': 'Some Channel',
+        'uploader_id': 'UC' + video_id,
+        'duration': rng.randint(120, 600),
+        'webpage_url': f'https://www.youtube.com/watch?v={video_id}',
+        'url': formats[-1]['url'],
+        'description': 'lyrics, links and credits ' * 40,
+        'tags': [f'tag{i}' for i in range(20)],
+        'formats': formats,
+        'thumbnails': [{'url': f'https://i.ytimg.com/vi/{video_id}/{i}.jpg', 'id': str(i)} for i in range(10)],
+        'subtitles': {lang: [{'ext': 'vtt', 'url': f'https://youtube.com/api/timedtext?v={video_id}&lang={lang}'}]
+                      for lang in ('en', 'de', 'fr', 'es')},
+        'extractor': 'youtube',
+    }
+
+def measure(build, count):
+    '''Returns the bytes still allocated after building count objects'''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = [build(i) for i in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return after - before
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory of full info dicts against TrackInfo')
+    parser.add_argument('--entries', type=int, default=50, help='songs per playlist')
+    parser.add_argument('--guilds', type=int, default=20, help='playlists')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    count = args.entries * args.guilds
+
+    full = measure(lambda i: fake_info(random.Random(args.seed + i), f'vid{i:08d}'), count)
+    compact = measure(lambda i: TrackInfo.from_info(
+        fake_info(random.Random(args.seed + i), f'vid{i:08d}'), f'youtube-vid{i:08d}.webm'), count)
+    # Each info dict is dropped once its TrackInfo is made, as SongInfo does
+
+    print(f'{count} entries ({args.guilds} playlists of {args.entries})')
+    print(f'     info dict: {full / count:10.0f} bytes/entry, {full / 2 ** 20:8.1f} MiB total')
+    print(f'     TrackInfo: {compact / count:10.0f} bytes/entry, {compact / 2 ** 20:8.1f} MiB total')
+    print(f'     {full / max(compact, 1):.0f}x smaller')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+'''
+cleanup.py is the cog that deletes the data of guilds the bot is no longer in.
+When the bot leaves a guild (or is kicked from it) every cog is told to forget it,
+through the custom "guild_data_purge" event, and its levels, xp history and settings
+are deleted from the database a batch at a time.
+Guilds left while the bot was offline are caught by a reconcile every few hours,
+which compares the guilds in the database with the guilds the bot is in.
+The events are: on_guild_remove
+The commands are: reconcile
+
+Band A:
+/1. Dynamic generation of objects based on complex user-defined use of OOP model;
+/2. Server-side scripting using request and response objects;
+/3. Cross-table parameterised SQL
+
+Key:
+Band A.1 = an example of: Dynamic generation of objects...
+'''
+
+import asyncio
+import time
+from discord.ext import commands
+
+RECONCILE_INTERVAL = 6 * 60 * 60    # Seconds between comparisons of the database with the guild list
+RECONCILE_DELAY = 5 * 60            # Seconds after startup before the first one, so the guild list is complete
+
+class Cleanup(commands.Cog):
+    '''Encapsulates the purging of departed guilds in the Cleanup class (Band A.1)'''
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.reconcile_task = bot.loop.create_task(self.keep_reconciled())
+
+    def cog_unload(self):
+        self.reconcile_task.cancel()
+
+    def owns(self, guild_id):
+        '''
+        Checks if one of this process' shards serves the guild.
+        Under launcher.py every worker shares the database, so a worker only
+        purges its own guilds and never the guilds of another worker
+        '''
+        shard_ids = self.bot.shard_ids
+        if shard_ids is None:
+            return True     # Auto-sharded in one process: every guild is ours
+        return (guild_id >> 22) % self.bot.shard_count in shard_ids
+
+    async def purge_guild(self, guild_id):
+        '''Makes every cog forget the guild, then deletes its rows; returns the rows deleted'''
+        self.bot.dispatch('guild_data_purge', guild_id)
+        await asyncio.sleep(0)  # Lets the listeners drop their caches first
+        await self.bot.db_ready.wait()
+        level = self.bot.get_cog('Level')
+        if level:
+            async with level.history_lock:
+                # Waits for an xp history write already in flight, which may still hold the guild's rows
+                deleted = await self.bot.levels.purge_guild(guild_id)
+        else:
+            deleted = await self.bot.levels.purge_guild(guild_id)
+        deleted += await self.bot.settings.purge(guild_id)
+        return deleted
+
+    async def departed_guilds(self):
+        '''The guilds this process serves that have data but no longer have the bot'''
+        await self.bot.db_ready.wait()
+        await self.bot.levels.prepare()
+        known = await self.bot.levels.guild_ids() | await self.bot.settings.guild_ids()
+        current = {guild.id for guild in self.bot.guilds}
+        return {guild_id for guild_id in known - current if self.owns(guild_id)}
+
+    async def reconcile(self):
+        '''Purges every departed guild; returns (guilds, rows) purged'''
+        if not self.bot.guilds:
+            return 0, 0     # Not connected yet, or the guild list is missing: purging now would delete everything
+        guilds = rows = 0
+        for guild_id in await self.departed_guilds():
+            if self.bot.get_guild(guild_id):
+                continue    # Rejoined while the others were purged
+            rows += await self.purge_guild(guild_id)
+            guilds += 1
+        return guilds, rows
+
+    async def keep_reconciled(self):
+        '''Reconciles shortly after startup and then every RECONCILE_INTERVAL'''
+        await self.bot.wait_until_ready()
+        await asyncio.sleep(RECONCILE_DELAY)
+        while True:
+            try:
+                guilds, rows = await self.reconcile()
+                if guilds:
+                    print(f"{time.strftime('%X')}: purged {rows} rows of {guilds} departed guilds")
+            except Exception as _e:
+                print(f"{time.strftime('%X')}: departed guilds could not be purged: {_e}")
+            await asyncio.sleep(RECONCILE_INTERVAL)
+
+    @commands.Cog.listener()
+    # (Band A.2)
+    async def on_guild_remove(self, guild):
+        '''Event is called when the bot leaves, is kicked from, or loses a guild'''
+        try:
+            rows = await self.purge_guild(guild.id)
+        except Exception as _e:
+            print(f"{time.strftime('%X')}: {guild.id} could not be purged, the reconcile will retry: {_e}")
+        else:
+            print(f"{time.strftime('%X')}: left {guild.id}, purged {rows} rows")
+
+    @commands.command(name='reconcile', hidden=True)
+    @commands.is_owner()
+    async def reconcile_command(self, ctx):
+        '''Purges the data of every guild the bot has left now, for the bot's owner only'''
+        start = time.perf_counter()
+        guilds, rows = await self.reconcile()
+        took = time.perf_counter() - start
+        await ctx.send(f'```Purged {rows} rows of {guilds} departed guilds in {took:.1f}s```')
+
+def setup(bot):
+    '''Entry point to the "r_bot.py" file (Band B.1)'''
+    bot.add_cog(Cleanup(bot))
+    # Registers the "cleanup.py" cog to the bot
@@ -2,7 +2,8 @@
 events.py is the cog that encapsulates the listeners a bot uses
 in the Discord guilds (servers) it has been invited to (running in).
 The events are: on_ready, on_message, on_message_join, on_reaction_add
-    on_reaction_remove, on_command_error
+    on_reaction_remove, on_command_error, on_guild_role_create/update/delete
+The commands are: lockdown, unlock, protection
 
 Band A:
 /1. Dynamic generation of objects based on complex user-defined use of OOP model;
@@ -18,17 +19,102 @@ Key:
 Band A.1 = an example of: Dynamic generation of objects...
 '''
 
+import asyncio
 import time
+from array import array
 import discord
 from discord.ext import commands
+from metrics import timed_listener
+from storage import DatabaseUnavailable, wait_until_open
 # (Band A.3)
 
+RAID_JOINS = 10     # This many joins...
+RAID_WINDOW = 10.0  # ...within this many seconds is treated as a raid
+LOCKDOWN_CALM = 300 # Seconds without a raid-rate of joins before a lockdown lifts itself
+ROLE_BATCH_DELAY = 0.5  # Seconds between role assignments when a lockdown lifts
+# Whether spammers are muted, after how many strikes and for how long,
+# and whether raids start a lockdown, are per-guild settings (see settings.py)
+
+class JoinWindow:
+    '''
+    Ring buffer of the last RAID_JOINS join times of one guild.
+    A raid is when the join being overwritten is still inside RAID_WINDOW,
+    so each join costs O(1) and a guild only costs RAID_JOINS doubles.
+    '''
+    __slots__ = ('times', 'index')
+
+    def __init__(self, size=RAID_JOINS):
+        self.times = array('d', [float('-inf')]) * size
+        self.index = 0
+
+    def add(self, now):
+        '''Records a join and returns True if the join rate is at raid level'''
+        oldest = self.times[self.index]
+        self.times[self.index] = now
+        self.index = (self.index + 1) % len(self.times)
+        return now - oldest <= RAID_WINDOW
+
+class Lockdown:
+    '''The state of a guild in lockdown: who joined and what to restore afterwards'''
+    __slots__ = ('pending', 'verification_level', 'last_raid_join', 'task')
+
+    def __init__(self, verification_level):
+        self.pending = set()    # Ids of members whose Newcomer role was held back
+        self.verification_level = verification_level
+        self.last_raid_join = time.monotonic()
+        self.task = None
+
 class Events(commands.Cog):
     '''Encapsulates all event listeners in the Events class (Band A.1)'''
     # This event class is instantiated with decoratored attributes, as with all cogs (Band A.1)
 
     def __init__(self, bot):
         self.bot = bot
+        self.join_windows = {}  # guild id -> JoinWindow
+        self.lockdowns = {}     # guild id -> Lockdown
+        self.newcomer_roles = {}    # guild id -> Newcomer role id (None if the guild has none)
+        self.exported = False   # Set when the state was handed to a reloaded copy
+
+    def export_state(self):
+        '''Hands the raid trackers and lockdowns over to the reloaded cog (see Owner.reload)'''
+        self.exported = True
+        return {'join_windows': self.join_windows, 'lockdowns': self.lockdowns,
+                'newcomer_roles': self.newcomer_roles}
+
+    def import_state(self, state):
+        '''
+        Takes over the state of the cog this one replaced.
+        Running lockdown timers share the same lockdowns dict, so they keep working
+        '''
+        self.join_windows = state['join_windows']
+        self.lockdowns = state['lockdowns']
+        self.newcomer_roles = state['newcomer_roles']
+
+    def cog_unload(self):
+        '''Stops the lockdown timers when the cog is unloaded for good'''
+        if self.exported:
+            return
+        for lockdown in self.lockdowns.values():
+            if lockdown.task:
+                lockdown.task.cancel()
+
+    @commands.Cog.listener()
+    async def on_guild_data_purge(self, guild_id):
+        '''Forgets the raid tracking of a guild the bot has left (see cleanup.py)'''
+        self.join_windows.pop(guild_id, None)
+        self.newcomer_roles.pop(guild_id, None)
+        lockdown = self.lockdowns.pop(guild_id, None)
+        if lockdown and lockdown.task:
+            lockdown.task.cancel()
+        self.bot.spam_filter.forget_guild(guild_id)
+
+    def newcomer_role(self, guild):
+        '''Gets the Newcomer role from the cached id, only searching the roles on a cache miss'''
+        if guild.id not in self.newcomer_roles:
+            role = discord.utils.get(guild.roles, name='Newcomer')
+            self.newcomer_roles[guild.id] = role.id if role else None
+        role_id = self.newcomer_roles[guild.id]
+        return guild.get_role(role_id) if role_id else None
 
     @commands.Cog.listener()
     # All listeners are essentially request and response objects (Band A.2)
@@ -48,6 +134,7 @@ class Events(commands.Cog):
         # Prints when the bot connected to the guild, in the shell
 
     @commands.Cog.listener()
+    @timed_listener('events.on_message')
     # (Band A.2)
     async def on_message(self, message):
         '''Event is called on every message recieved by the bot'''
@@ -56,6 +143,14 @@ class Events(commands.Cog):
         # Makes sure the bot doesn't reply to itself
             return
 
+        strikes = self.bot.spam_filter.check(message)
+        if strikes:
+            settings = self.bot.settings.snapshot(message.guild.id)
+            if settings['spam_mute'] and strikes == settings['spam_strikes']:
+                await self.mute(message.author, settings['spam_mute_time'])
+            return
+        # Spam is ignored here, and Level doesn't give xp for it either
+
         print(
             f"{time.strftime('%X')}: {message.channel}: {message.author}: {message.content}"
         )
@@ -70,16 +165,167 @@ class Events(commands.Cog):
         # - the bot will respond with "Hi <user who typed the message>"
         # followed by a smiley face (integrated within the Discord app.)
 
+    async def mute(self, member, seconds):
+        '''Gives a spammer the Muted role and takes it away after the given time'''
+
+        role = discord.utils.get(member.guild.roles, name='Muted')
+        if not role:
+            return
+        try:
+            await member.add_roles(role, reason='Spamming')
+            await asyncio.sleep(seconds)
+            await member.remove_roles(role, reason='Mute expired')
+        except discord.HTTPException:
+            pass    # The member left or the bot can't manage the role
+
     @commands.Cog.listener()
     # (Band A.2)
     async def on_member_join(self, member):
         '''Event is called when a member joins the guild'''
 
-        role = discord.utils.get(member.guild.roles, name='Newcomer')
-        await member.add_roles(role)
+        guild = member.guild
+        window = self.join_windows.setdefault(guild.id, JoinWindow())
+        raid = window.add(time.monotonic())
+
+        lockdown = self.lockdowns.get(guild.id)
+        if raid and not lockdown and self.bot.settings.get(guild.id, 'raid_lockdown'):
+            lockdown = await self.start_lockdown(guild)
+            print(f"{time.strftime('%X')}: raid detected in {guild}, lockdown started")
+
+        if lockdown:
+            if raid:
+                lockdown.last_raid_join = time.monotonic()
+            lockdown.pending.add(member.id)
+            return  # The Newcomer role is given out in one batch when the lockdown lifts
+
+        role = self.newcomer_role(guild)
+        if role:
+            await member.add_roles(role)
         # Autoroles the member to the newcomer role
 
-        print(f"{member.author} has joined the guild")
+        print(f"{member} has joined the guild")
+
+    async def start_lockdown(self, guild):
+        '''Pauses autoroles and requires verification until the raid is over'''
+
+        lockdown = Lockdown(guild.verification_level)
+        self.lockdowns[guild.id] = lockdown
+        try:
+            await guild.edit(verification_level=discord.VerificationLevel.high)
+        except discord.HTTPException:
+            pass    # Lockdown still holds the roles back without Manage Guild
+        lockdown.task = self.bot.loop.create_task(self.lift_when_calm(guild.id))
+        return lockdown
+
+    async def lift_when_calm(self, guild_id):
+        '''Lifts a lockdown once LOCKDOWN_CALM seconds pass without raid-rate joins'''
+
+        while True:
+            lockdown = self.lockdowns.get(guild_id)
+            if not lockdown:
+                return
+            remaining = lockdown.last_raid_join + LOCKDOWN_CALM - time.monotonic()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(remaining)
+
+        guild = self.bot.get_guild(guild_id)
+        if guild:
+            await self.end_lockdown(guild)
+
+    async def end_lockdown(self, guild):
+        '''Restores verification and gives the held back members their role in one paced batch'''
+
+        lockdown = self.lockdowns.pop(guild.id, None)
+        if not lockdown:
+            return 0
+        if lockdown.task and lockdown.task is not asyncio.current_task():
+            lockdown.task.cancel()
+
+        try:
+            await guild.edit(verification_level=lockdown.verification_level)
+        except discord.HTTPException:
+            pass
+
+        role = self.newcomer_role(guild)
+        given = 0
+        for member_id in lockdown.pending:
+            member = guild.get_member(member_id)
+            if role and member and role not in member.roles:
+                await member.add_roles(role)
+                given += 1
+                await asyncio.sleep(ROLE_BATCH_DELAY)
+        # Members who were kicked or banned during the raid are skipped
+        return given
+
+    @commands.command()
+    @commands.has_permissions(manage_guild=True)
+    async def lockdown(self, ctx):
+        '''Puts the guild in lockdown: autoroles paused and verification required'''
+
+        if ctx.guild.id in self.lockdowns:
+            return await ctx.send('The guild is already in lockdown')
+        await self.start_lockdown(ctx.guild)
+        await ctx.send('The guild is now in lockdown')
+
+    @commands.command()
+    @commands.has_permissions(manage_guild=True)
+    async def unlock(self, ctx):
+        '''Lifts a lockdown and gives the held back members the Newcomer role'''
+
+        if ctx.guild.id not in self.lockdowns:
+            return await ctx.send('The guild is not in lockdown')
+        given = await self.end_lockdown(ctx.guild)
+        await ctx.send(f'Lockdown lifted, {given} members were given the Newcomer role')
+
+    @commands.command(aliases=['prot'])
+    @commands.has_permissions(manage_guild=True)
+    async def protection(self, ctx, setting: str = None, value: str = None):
+        '''
+        Shows or changes the guild's spam and raid protection, e.g.
+        "r-protection mute off", "r-protection strikes 5", "r-protection mutetime 300",
+        "r-protection lockdown off", "r-protection reset"
+        '''
+
+        await wait_until_open(self.bot)     # A change made before the settings load would be lost
+        setting = setting.lower() if setting else None
+        keys = {'mute': 'spam_mute', 'strikes': 'spam_strikes',
+                'mutetime': 'spam_mute_time', 'lockdown': 'raid_lockdown'}
+
+        if setting == 'reset':
+            await self.bot.settings.reset(ctx.guild.id, *keys.values())
+        elif setting in keys and value is not None:
+            if setting in ('strikes', 'mutetime') and (not value.isdigit() or int(value) < 1):
+                raise commands.BadArgument(f'{setting} must be a whole number above 0')
+            try:
+                await self.bot.settings.update(ctx.guild.id, **{keys[setting]: value})
+            except ValueError:
+                raise commands.BadArgument(f'`{value}` does not fit {setting}')
+        elif setting:
+            raise commands.BadArgument(f'Unknown protection setting `{setting}`')
+
+        settings = self.bot.settings.snapshot(ctx.guild.id)
+        await ctx.send(
+            f"```Spam mute: {'on' if settings['spam_mute'] else 'off'}, after {settings['spam_strikes']} strikes, "
+            f"for {settings['spam_mute_time']}s\n"
+            f"Raid lockdown: {'on' if settings['raid_lockdown'] else 'off'}```"
+        )
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role):
+        '''Forgets the cached Newcomer role so the next join looks it up again'''
+        self.newcomer_roles.pop(role.guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role):
+        '''Forgets the cached Newcomer role so the next join looks it up again'''
+        self.newcomer_roles.pop(role.guild.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after):
+        '''Forgets the cached Newcomer role if a role was renamed'''
+        if before.name != after.name:
+            self.newcomer_roles.pop(after.guild.id, None)
 
     @commands.Cog.listener()
     # (Band A.2)
@@ -120,6 +366,8 @@ class Events(commands.Cog):
             await ctx.send("I don't have permission to do that!")
         if isinstance(error, commands.CommandNotFound):
             await ctx.send("Err0r 404: Command not found!")
+        if isinstance(getattr(error, 'original', None), DatabaseUnavailable):
+            await ctx.send(str(error.original))
 
         raise error
 
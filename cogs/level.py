@@ -2,7 +2,7 @@
 level.py is the cog that encapsulates all the algorithms the bot uses
 to maintain a database of users info (user id, guild id, level and experience).
 The events are: on_message
-The commands are: level
+The commands are: level, xppolicy, top
 
 Band A:
 /1. Dynamic generation of objects based on complex user-defined use of OOP model
@@ -23,13 +23,181 @@ Key:
 Band A.1 = an example of: Dynamic generation of objects...
 '''
 
+import asyncio
+import collections
+import random
+import time
 import discord
 from discord.ext import commands
+from metrics import timed_listener
+from paginator import build_pages, paginate
+from storage import wait_until_open
+
+SWEEP_SIZE = 5000   # Cooldown entries kept before the expired ones are swept out
+HOUR = 3600
+DAY = 86400
+FLUSH_INTERVAL = 30     # Seconds between batched writes of the xp history
+FLUSH_SIZE = 1000       # Buckets waiting to be written that trigger an early write
+ROLLUP_INTERVAL = HOUR  # Seconds between rollups of the hourly buckets into days
+HOURLY_KEEP = 2 * DAY   # Hourly buckets older than this are rolled up into daily ones
+DAILY_KEEP = 90 * DAY   # Daily buckets older than this are deleted
+LEADERBOARD_SIZE = 50
+PERIODS = {'week': 7 * DAY, 'month': 30 * DAY}
+
+class XPPolicy:
+    '''How a guild hands out xp, read from its settings (see settings.py)'''
+    __slots__ = ('cooldown', 'min_length', 'xp_min', 'xp_max', 'allowed', 'denied')
+
+    def __init__(self, settings):
+        self.cooldown = settings['xp_cooldown']         # Seconds before a member can gain xp again
+        self.min_length = settings['xp_min_length']     # Shorter messages (e.g. "k") give no xp
+        self.xp_min = settings['xp_min']
+        self.xp_max = settings['xp_max']                # Each xp gain is a random amount in [xp_min, xp_max]
+        self.allowed = frozenset(settings['xp_allowed'])    # If not empty, only these channel ids give xp
+        self.denied = frozenset(settings['xp_denied'])      # These channel ids never give xp
+
+    def channel_allowed(self, channel_id):
+        '''Checks the channel against the allow and deny lists'''
+        if channel_id in self.denied:
+            return False
+        return not self.allowed or channel_id in self.allowed
+
+    def __str__(self):
+        allowed = ', '.join(f'<#{c}>' for c in self.allowed) or 'all'
+        denied = ', '.join(f'<#{c}>' for c in self.denied) or 'none'
+        return (f'Cooldown: {self.cooldown}s | Min length: {self.min_length} | '
+                f'XP: {self.xp_min}-{self.xp_max} | Allowed: {allowed} | Denied: {denied}')
+
+class CooldownMap:
+    '''
+    Expiring map of (guild id, user id) -> time the cooldown ends.
+    Most messages are answered here, without touching the database.
+    '''
+
+    def __init__(self):
+        self.expiries = {}
+        self.sweep_at = SWEEP_SIZE  # Size the map must reach before the next sweep
+
+    def on_cooldown(self, key, now):
+        '''Checks if key is still cooling down'''
+        return self.expiries.get(key, 0) > now
+
+    def start(self, key, now, seconds):
+        '''
+        Starts the cooldown of key, sweeping out expired entries when the map gets big.
+        After a sweep the map must double before the next one, so a map full of live
+        cooldowns is not rebuilt on every message (amortised O(1))
+        '''
+        self.expiries[key] = now + seconds
+        if len(self.expiries) > self.sweep_at:
+            self.expiries = {k: end for k, end in self.expiries.items() if end > now}
+            self.sweep_at = max(SWEEP_SIZE, 2 * len(self.expiries))
 
 class Level(commands.Cog):
     '''Encapsulates all algorithms & commands in the Levels class (Band A.1)'''
     def __init__(self, bot):
         self.bot = bot
+        self.policies = {}  # guild id -> (settings snapshot, XPPolicy built from it)
+        self.cooldowns = CooldownMap()
+        self.activity = collections.Counter()   # (guild id, user id, hour) -> xp not written yet
+        self.flushed = asyncio.Event()          # Set to write the xp history before FLUSH_INTERVAL is up
+        self.history_lock = asyncio.Lock()      # Held while the xp history is written, rolled up or pruned
+        self.exported = False
+        self.history_task = bot.loop.create_task(self.keep_history())
+
+    def export_state(self):
+        '''Hands the cooldowns and unwritten xp history over to the reloaded cog (see Owner.reload)'''
+        self.exported = True
+        return {'cooldowns': self.cooldowns, 'activity': self.activity}
+
+    def import_state(self, state):
+        '''Takes over the state of the cog this one replaced'''
+        self.cooldowns = state['cooldowns']
+        self.activity.update(state['activity'])
+
+    def cog_unload(self):
+        '''Stops the history task, writing what it still holds unless a reloaded cog takes it over'''
+        self.history_task.cancel()
+        if not self.exported and self.activity:
+            self.bot.loop.create_task(self.write_activity())
+
+    @commands.Cog.listener()
+    async def on_guild_data_purge(self, guild_id):
+        '''Drops the cached policy, cooldowns and unwritten xp of a guild the bot has left (see cleanup.py)'''
+        self.policies.pop(guild_id, None)
+        expiries = self.cooldowns.expiries
+        for key in [key for key in expiries if key[0] == guild_id]:
+            del expiries[key]
+        for key in [key for key in self.activity if key[0] == guild_id]:
+            del self.activity[key]
+
+    def record_activity(self, guild_id, user_id, xp):
+        '''Adds xp to the member's bucket for this hour; written to the database in batches'''
+        now = int(time.time())
+        self.activity[(guild_id, user_id, now - now % HOUR)] += xp
+        if len(self.activity) >= FLUSH_SIZE:
+            self.flushed.set()
+
+    async def write_activity(self):
+        '''Writes the buckets gathered since the last write in one batch (Band A.5)'''
+        async with self.history_lock:
+            rows, self.activity = self.activity, collections.Counter()
+            if not rows:
+                return
+            try:
+                await self.bot.levels.record_activity([(*key, xp) for key, xp in rows.items()])
+            except Exception:
+                rows.update(self.activity)  # Kept for the next try
+                self.activity = rows
+                raise
+
+    async def keep_history(self):
+        '''Writes the xp history in batches, and rolls up and prunes the old buckets every hour'''
+        await self.bot.db_ready.wait()
+        await self.bot.levels.prepare()
+        last_rollup = 0
+        while True:
+            try:
+                await asyncio.wait_for(self.flushed.wait(), FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.flushed.clear()
+            try:
+                await self.write_activity()
+                now = int(time.time())
+                if now - last_rollup >= ROLLUP_INTERVAL:
+                    async with self.history_lock:
+                        await self.bot.levels.rollup(now - HOURLY_KEEP)
+                        await self.bot.levels.prune(now - DAILY_KEEP)
+                    last_rollup = now
+            except Exception as _e:
+                print(f"{time.strftime('%X')}: xp history could not be written: {_e}")
+
+    def get_policy(self, guild_id):
+        '''
+        Returns the guild's xp policy, rebuilt only when its settings changed:
+        a settings change swaps in a new snapshot, so a different object means a stale policy
+        '''
+        settings = self.bot.settings.snapshot(guild_id)
+        cached = self.policies.get(guild_id)
+        if cached is None or cached[0] is not settings:
+            cached = self.policies[guild_id] = (settings, XPPolicy(settings))
+        return cached[1]
+
+    def earns_xp(self, message):
+        '''Applies the guild's xp policy to a message, all in memory (Band B.1)'''
+        policy = self.get_policy(message.guild.id)
+        if len(message.content) < policy.min_length:
+            return 0
+        if not policy.channel_allowed(message.channel.id):
+            return 0
+
+        key = (message.guild.id, message.author.id)
+        now = time.monotonic()
+        if self.cooldowns.on_cooldown(key, now):
+            return 0
+        self.cooldowns.start(key, now, policy.cooldown)
+        return random.randint(policy.xp_min, policy.xp_max)
 
     async def lvl_up(self, user):
         '''The algorithm that updates the user's level (Band B.1)'''
@@ -38,52 +206,29 @@ class Level(commands.Cog):
 
         if current_xp >= round((4 * (current_lvl ** 3)) / 5):
         # Computes the next current xp (Band C.1)
-            await self.bot.pg_con.execute(
-                """
-                UPDATE users
-                SET level = $1
-                WHERE user_id = $2 AND guild_id = $3
-                """,
-                current_lvl + 1, user['user_id'], user['guild_id']
-            )   # Updates the user's record in the database (Band C.2)
-            # Dollar sign used as placeholder for variable names not defined in SQL (Band A.5)
+            await self.bot.levels.set_level(user['user_id'], user['guild_id'], current_lvl + 1)
+            # Updates the user's record in the database (Band C.2)
             return True
         return False
 
     @commands.Cog.listener()
+    @timed_listener('level.on_message')
     # (Band A.2)
     async def on_message(self, ctx):
         '''Event is called on every message recieved by the bot and levels up the user'''
         if ctx.author == self.bot.user: # Doesn't level up the bot itself
             return
+        if not ctx.guild or self.bot.spam_filter.check(ctx):
+            return  # Private messages and spam give no xp, and cost no database trips
+
+        gain = self.earns_xp(ctx)
+        if not gain:
+            return  # Cooldowns, short messages and denied channels never reach the database
+        await wait_until_open(self.bot)     # The pool may still be warming up just after startup
 
-        user = await self.bot.pg_con.fetchrow(
-            """
-            SELECT *
-            FROM users
-            WHERE user_id = $1 AND guild_id = $2
-            """,
-            ctx.author.id, ctx.guild.id
-        )   # (Band A.5; C.2)
-
-        if not user: # Creates a new user if user is returned false
-            user = await self.bot.pg_con.fetchrow(
-                """
-                INSERT INTO users (user_id, guild_id)
-                VALUES ($1, $2)
-                RETURNING *
-                """,
-                ctx.author.id, ctx.guild.id
-            )   # (Band A.5; C.2)
-
-        await self.bot.pg_con.execute(
-            """
-            UPDATE users
-            SET xp = $1
-            WHERE user_id = $2 AND guild_id = $3
-            """,
-            user['xp'] + 1, ctx.author.id, ctx.guild.id
-        )   # Finds the user and gives them +1 xp (Band A.5; C.1; C.2) 
+        user = await self.bot.levels.add_xp(ctx.author.id, ctx.guild.id, gain)
+        # Finds (or creates) the user and gives them the xp gained (Band A.5; C.1; C.2)
+        self.record_activity(ctx.guild.id, ctx.author.id, gain)
 
         if await self.lvl_up(user): # Sends a mention to the user that they have levelled up
             await ctx.channel.send(f"{ctx.author.mention} is now level {user['level'] + 1}")
@@ -96,34 +241,10 @@ class Level(commands.Cog):
 
         member = ctx.author if not member else member
         # If no member argument is given, then the member is the user who typed the message
+        await wait_until_open(self.bot)
 
-        user = await self.bot.pg_con.fetchrow(
-            """
-            SELECT *
-            FROM users
-            WHERE user_id = $1 AND guild_id = $2
-            """,
-            member.id, member.guild.id
-        )   # (Band A.5)
-
-        if not user:
-            user = await self.bot.pg_con.fetchrow(
-                """
-                INSERT INTO users (user_id, guild_id)
-                VALUES ($1, $2)
-                RETURNING *
-                """,
-                member.id, member.guild.id
-            )   # Creates a new user if user is returned as false (Band A.5; C.2)
-
-        await self.bot.pg_con.execute(
-            """
-            UPDATE users
-            SET xp = $1
-            WHERE user_id = $2 AND guild_id = $3
-            """,
-            user['xp'], member.id, member.guild.id
-        )   # Updates the user's record to match their current data (Band A.5; C.2)
+        user = await self.bot.levels.get_user(member.id, member.guild.id)
+        # Creates a new user if they don't have a record yet (Band A.5; C.2)
 
         embed = discord.Embed(
             color=member.color,
@@ -138,6 +259,66 @@ class Level(commands.Cog):
         await ctx.send(embed=embed)
         print(user['user_id'])
 
+    @commands.command(aliases=['xpp'])
+    @commands.has_permissions(manage_guild=True)
+    async def xppolicy(self, ctx, setting: str = None, *values):
+        '''
+        Shows or changes how this guild gives out xp, e.g.
+        "r-xppolicy cooldown 60", "r-xppolicy range 1 5", "r-xppolicy minlength 5",
+        "r-xppolicy allow #channel", "r-xppolicy deny #channel", "r-xppolicy reset"
+        '''
+
+        await wait_until_open(self.bot)     # A change made before the settings load would be lost
+        policy = self.get_policy(ctx.guild.id)
+        setting = setting.lower() if setting else None
+        channels = {int(c.strip('<#>')) for c in values if c.strip('<#>').isdigit()}
+        guild_id = ctx.guild.id
+
+        if setting == 'cooldown' and len(values) == 1 and values[0].isdigit():
+            await self.bot.settings.update(guild_id, xp_cooldown=int(values[0]))
+        elif setting == 'minlength' and len(values) == 1 and values[0].isdigit():
+            await self.bot.settings.update(guild_id, xp_min_length=int(values[0]))
+        elif setting == 'range' and len(values) == 2 and all(v.isdigit() for v in values):
+            xp_min, xp_max = sorted(int(v) for v in values)
+            await self.bot.settings.update(guild_id, xp_min=xp_min, xp_max=xp_max)
+        elif setting in ('allow', 'deny') and channels:
+            listed = policy.allowed if setting == 'allow' else policy.denied
+            listed = sorted(listed.symmetric_difference(channels))
+            # Naming a listed channel again takes it off the list
+            key = 'xp_allowed' if setting == 'allow' else 'xp_denied'
+            await self.bot.settings.update(guild_id, **{key: listed})
+        elif setting == 'reset':
+            await self.bot.settings.reset(guild_id, 'xp_cooldown', 'xp_min_length', 'xp_min',
+                                          'xp_max', 'xp_allowed', 'xp_denied')
+        elif setting:
+            raise commands.BadArgument(f'Unknown xp policy setting `{setting}`')
+
+        await ctx.send(f'```{self.get_policy(guild_id)}```')
+
+    @commands.command(aliases=['leaderboard', 'lb'])
+    @commands.guild_only()
+    async def top(self, ctx, period: str = 'week'):
+        '''Shows who gained the most xp this week or month, e.g. "r-top week", "r-top month"'''
+
+        period = period.lower()
+        if period not in PERIODS:
+            raise commands.BadArgument('Choose `week` or `month`')
+        await wait_until_open(self.bot)
+        await self.write_activity()     # So the last few minutes count too
+
+        since = int(time.time()) - PERIODS[period]
+        rows = await self.bot.levels.leaderboard(ctx.guild.id, since, LEADERBOARD_SIZE)
+        # Only the hourly and daily buckets are read, never every message (Band A.5)
+
+        fields = []
+        for rank, (user_id, xp) in enumerate(rows, start=1):
+            member = ctx.guild.get_member(user_id)
+            fields.append((f'#{rank} {member.display_name if member else user_id}', f'{xp} xp'))
+        if not fields:
+            fields = [('Nobody yet', 'No xp was gained in this period')]
+        pages = build_pages(f'Most active this {period}', fields, colour=discord.Colour.gold())
+        await paginate(self.bot, ctx, ctx.author, pages)
+
 def setup(bot):
     '''Entry point to the "r_bot.py" file (Band B.1)'''
     bot.add_cog(Level(bot))
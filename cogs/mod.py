@@ -1,7 +1,7 @@
 '''
 mod.py is the cog that encapsulates all the commands a Moderator user
 of a given Discord guild (server) would use (to moderate other players).
-The current commands are: kick, ban, clear
+The current commands are: kick, ban, massban, masskick, clear, cancelclear
 
 Band A:
 /1. Dynamic generation of objects based on complex user-defined use of OOP model;
@@ -18,14 +18,204 @@ Key:
 Band A.1 = an example of: Dynamic generation of objects...
 '''
 
+import asyncio
+import datetime
+import re
+import time
 import discord
 from discord.ext import commands
 # (Band A.4)
 
+BULK_LIMIT = 100    # Discord bulk deletes at most 100 messages per call
+BULK_MAX_AGE = datetime.timedelta(days=14)  # Older messages can't be bulk deleted
+PROGRESS_INTERVAL = 2   # Seconds between edits of the progress message
+MASS_CONCURRENCY = 3    # Kicks/bans in flight at once during a mass action
+MASS_RETRIES = 3        # Attempts per member when Discord rate limits us
+CONFIRM_EMOJI = '\N{WHITE HEAVY CHECK MARK}'
+
+AUDIT_TABLE = """
+    CREATE TABLE IF NOT EXISTS mod_audit (
+        id SERIAL PRIMARY KEY,
+        guild_id BIGINT NOT NULL,
+        moderator_id BIGINT NOT NULL,
+        target_id BIGINT NOT NULL,
+        action TEXT NOT NULL,
+        reason TEXT,
+        success BOOLEAN NOT NULL,
+        created_at TIMESTAMP NOT NULL DEFAULT now()
+    )
+    """
+
+def parse_mass_options(text):
+    '''
+    Splits the text after the members of "r-massban"/"r-masskick" into filters and a reason, e.g.
+    "r-massban joined:30 name:^spam\\d+ raid accounts" bans everyone who joined
+    in the last 30 minutes with a name like spam123, for the reason "raid accounts"
+    '''
+
+    joined, pattern, reason = None, None, []
+    for token in (text or '').split():
+        key, _, value = token.partition(':')
+        if key == 'joined' and value.isdigit():
+            joined = datetime.timedelta(minutes=int(value))
+        elif key == 'name' and value:
+            try:
+                pattern = re.compile(value, re.IGNORECASE)
+            except re.error:
+                raise commands.BadArgument(f'Invalid regex `{value}`')
+        else:
+            reason.append(token)
+    return joined, pattern, ' '.join(reason) or 'No reason'
+
+async def run_bulk_action(targets, action, concurrency=MASS_CONCURRENCY):
+    '''
+    Applies the coroutine function action to every target with at most
+    concurrency calls in flight, backing off when Discord answers 429.
+    Returns a list of (target, error) pairs, error being None on success.
+    '''
+
+    queue = asyncio.Queue()
+    for target in targets:
+        queue.put_nowait(target)
+    results = []
+
+    async def worker():
+        while not queue.empty():
+            target = queue.get_nowait()
+            error = None
+            for _ in range(MASS_RETRIES):
+                try:
+                    await action(target)
+                    error = None
+                    break
+                except discord.HTTPException as _e:
+                    error = _e
+                    if _e.status != 429:
+                        break
+                    await asyncio.sleep(getattr(_e, 'retry_after', None) or 1)
+            results.append((target, error))
+
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, len(targets)))))
+    return results
+
+def parse_purge_filters(tokens):
+    '''
+    Turns the extra arguments of "r-clear" into filter options, e.g.
+    "r-clear 50 author:@user regex:^http attachments before:<message id> after:<message id>"
+    '''
+
+    options = {'author': None, 'regex': None, 'attachments': False, 'before': None, 'after': None}
+    for token in tokens:
+        key, _, value = token.partition(':')
+        key = key.lower()
+        if key == 'attachments' and not value:
+            options['attachments'] = True
+        elif key == 'author' and value:
+            ids = re.findall(r'\d{15,21}', value)
+            if not ids:
+                raise commands.BadArgument(f'Unknown author `{value}`')
+            options['author'] = int(ids[0])
+        elif key == 'regex' and value:
+            try:
+                options['regex'] = re.compile(value)
+            except re.error:
+                raise commands.BadArgument(f'Invalid regex `{value}`')
+        elif key in ('before', 'after') and value.isdigit():
+            options[key] = discord.Object(id=int(value))
+        else:
+            raise commands.BadArgument(f'Unknown filter `{token}`')
+    return options
+
+class PurgeJob:
+    '''
+    A background purge of one channel. History is streamed newest first and
+    filtered as it arrives; recent messages are bulk deleted in chunks of 100,
+    messages older than 14 days have to be deleted one by one.
+    '''
+
+    def __init__(self, channel, amount, options, before):
+        self.channel = channel
+        self.amount = amount
+        self.options = options
+        self.before = options['before'] or before
+        self.after = options['after']
+        self.scan_limit = max(amount * 5, 500)  # Stops filters from walking all history
+        self.deleted = 0
+        self.scanned = 0
+        self.task = None
+        self.cancelled = False
+        self._last_report = 0
+
+    def cancel(self):
+        '''Stops the job, including one cancelled before its task was started'''
+        self.cancelled = True
+        if self.task:
+            self.task.cancel()
+
+    def matches(self, msg):
+        '''Checks a single streamed message against the filters'''
+        opts = self.options
+        if msg.pinned:
+            return False
+        if opts['author'] and msg.author.id != opts['author']:
+            return False
+        if opts['attachments'] and not msg.attachments:
+            return False
+        if opts['regex'] and not opts['regex'].search(msg.content):
+            return False
+        return True
+
+    async def report(self, status, force=False):
+        '''Edits the one status message, at most every PROGRESS_INTERVAL seconds'''
+        now = time.monotonic()
+        if force or now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            await status.edit(content=f'Clearing... {self.deleted}/{self.amount} deleted, '
+                                      f'{self.scanned} messages scanned')
+
+    async def run(self, status):
+        '''Streams the history and deletes matching messages until amount is reached'''
+        bulk_cutoff = discord.utils.time_snowflake(datetime.datetime.utcnow() - BULK_MAX_AGE)
+        bulk = []
+
+        history = self.channel.history(limit=self.scan_limit, before=self.before, after=self.after,
+                                       oldest_first=False)
+        # With after= the history would otherwise come oldest first
+        async for msg in history:
+            self.scanned += 1
+            if not self.matches(msg):
+                continue
+
+            if msg.id > bulk_cutoff:
+                bulk.append(msg)
+                if len(bulk) == BULK_LIMIT or self.deleted + len(bulk) >= self.amount:
+                    await self.channel.delete_messages(bulk)
+                    self.deleted += len(bulk)
+                    bulk = []
+            else:
+                # History is newest first, so everything from here on is too old to bulk delete
+                if bulk:
+                    await self.channel.delete_messages(bulk)
+                    self.deleted += len(bulk)
+                    bulk = []
+                await msg.delete()
+                self.deleted += 1
+
+            await self.report(status)
+            if self.deleted >= self.amount:
+                break
+
+        if bulk:
+            await self.channel.delete_messages(bulk)
+            self.deleted += len(bulk)
+
 class Mod(commands.Cog):
     '''Encapsulates all moderation commands in the Mod class (Band A.1)'''
     def __init__(self, bot):
         self.bot = bot
+        self.purge_jobs = {}    # One running purge per channel id
+        self.audit_ready = False    # Whether the mod_audit table has been created
+        self.exported = False   # Set when the state was handed to a reloaded copy
 
     @commands.command(aliases=['k'])
     @commands.has_permissions(kick_members=True)
@@ -55,18 +245,194 @@ class Mod(commands.Cog):
             f'{member.mention} was banned by {ctx.author.mention} for: `[{reason}]`'
         )   # (Band B.1)
 
+    def mass_targets(self, ctx, members, joined, pattern):
+        '''Collects the members a mass action applies to, leaving out anyone it mustn't touch'''
+
+        targets = {member.id: member for member in members}
+        if joined or pattern:
+            now = datetime.datetime.utcnow()
+            for member in ctx.guild.members:
+                if joined and (not member.joined_at or now - member.joined_at > joined):
+                    continue
+                if pattern and not pattern.search(member.name):
+                    continue
+                targets[member.id] = member
+        # Members given by name and members matched by the filters are merged
+
+        return [
+            member for member in targets.values()
+            if member != ctx.author and member != ctx.guild.me
+            and member != ctx.guild.owner and member.top_role < ctx.author.top_role
+        ]   # Moderators can't remove themselves, the bot, the owner or anyone above them
+
+    async def confirm(self, ctx, text):
+        '''Asks the moderator to confirm a mass action with a reaction'''
+
+        msg = await ctx.send(text)
+        await msg.add_reaction(CONFIRM_EMOJI)
+        try:
+            await self.bot.wait_for(
+                'reaction_add', timeout=30,
+                check=lambda reaction, user: (user == ctx.author and reaction.message.id == msg.id
+                                              and str(reaction.emoji) == CONFIRM_EMOJI)
+            )
+        except asyncio.TimeoutError:
+            await msg.edit(content='Cancelled, nobody confirmed in time')
+            return False
+        return True
+
+    async def write_audit(self, ctx, action, reason, results):
+        '''Writes one audit row per target in a single round trip to the database'''
+
+        if not getattr(self.bot, 'pg_con', None):
+            return
+        if not self.audit_ready:
+            await self.bot.pg_con.execute(AUDIT_TABLE)
+            self.audit_ready = True
+
+        await self.bot.pg_con.executemany(
+            """
+            INSERT INTO mod_audit (guild_id, moderator_id, target_id, action, reason, success)
+            VALUES ($1, $2, $3, $4, $5, $6)
+            """,
+            [(ctx.guild.id, ctx.author.id, member.id, action, reason, error is None)
+             for member, error in results]
+        )   # (Band A.5)
+
+    async def mass_action(self, ctx, action, members, options):
+        '''Shared body of massban and masskick'''
+
+        joined, pattern, reason = parse_mass_options(options)
+        warning = ''
+        if (joined or pattern) and not ctx.guild.chunked:
+            if self.bot.intents.members:
+                await ctx.guild.chunk()     # The filters only see cached members
+            if not ctx.guild.chunked:
+                warning = (f'\nOnly {len(ctx.guild.members)} of {ctx.guild.member_count} members are cached '
+                           '(is the members intent enabled?), so the filters may miss some')
+        targets = self.mass_targets(ctx, members, joined, pattern)
+        if not targets:
+            return await ctx.send('No members matched' + warning)
+
+        if not await self.confirm(ctx, f'React with {CONFIRM_EMOJI} to {action} {len(targets)} members' + warning):
+            return
+
+        status = await ctx.send(f'Running {action} on {len(targets)} members...')
+        if action == 'ban':
+            results = await run_bulk_action(
+                targets, lambda member: member.ban(reason=reason, delete_message_days=1))
+        else:
+            results = await run_bulk_action(targets, lambda member: member.kick(reason=reason))
+
+        failed = [member for member, error in results if error]
+        summary = f'{action.capitalize()}: {len(results) - len(failed)} succeeded, {len(failed)} failed'
+        if failed:
+            summary += '\nFailed: ' + ', '.join(str(member) for member in failed[:20])
+        await status.edit(content=summary)
+
+        await self.write_audit(ctx, action, reason, results)
+
+    @commands.command(aliases=['mb'])
+    @commands.has_permissions(ban_members=True)
+    async def massban(self, ctx, members: commands.Greedy[discord.Member], *, options=None):
+        '''
+        Bans many members at once
+        i.e. "r-massban @a @b joined:10 name:^raid reason"
+        '''
+
+        await self.mass_action(ctx, 'ban', members, options)
+
+    @commands.command(aliases=['mk'])
+    @commands.has_permissions(kick_members=True)
+    async def masskick(self, ctx, members: commands.Greedy[discord.Member], *, options=None):
+        '''
+        Kicks many members at once
+        i.e. "r-masskick @a @b joined:10 name:^raid reason"
+        '''
+
+        await self.mass_action(ctx, 'kick', members, options)
+
     @commands.command(aliases=['c'])
     @commands.has_permissions(manage_messages=True)
-    async def clear(self, ctx, amount: int):
-        '''Clears the past messages'''
+    async def clear(self, ctx, amount: int, *filters):
+        '''
+        Clears the past messages in the background
+        Filters: author:@user regex:<pattern> attachments before:<id> after:<id>
+        '''
+
+        if amount < 1:
+            raise commands.BadArgument('amount must be positive')
+        if ctx.channel.id in self.purge_jobs:
+            return await ctx.send('A clear is already running here, use `cancelclear` to stop it')
+
+        options = parse_purge_filters(filters)
+        job = PurgeJob(ctx.channel, amount, options, before=ctx.message)
+        self.purge_jobs[ctx.channel.id] = job
+        # Registered before the first await, so a second clear in the channel is refused
+        try:
+            await ctx.message.delete()  # The command message itself is never counted
+            status = await ctx.send('Clearing...')
+        except discord.HTTPException:
+            self.purge_jobs.pop(ctx.channel.id, None)
+            raise
+        if job.cancelled:
+            self.purge_jobs.pop(ctx.channel.id, None)
+            return await status.edit(content='Clear cancelled, 0 messages were deleted')
+
+        job.task = self.bot.loop.create_task(self._run_purge(job, status))
+        # The command returns straight away; the job reports through the status message (Band B.1)
+
+    async def _run_purge(self, job, status):
+        '''Runs a purge job and writes its final result to the status message'''
+        try:
+            await job.run(status)
+            await status.edit(content=f'{job.deleted} messages were deleted')
+        except asyncio.CancelledError:
+            await status.edit(content=f'Clear cancelled, {job.deleted} messages were deleted')
+        except discord.HTTPException as _e:
+            await status.edit(content=f'Clear stopped after {job.deleted} messages: {_e.text}')
+        finally:
+            self.purge_jobs.pop(job.channel.id, None)
+
+    @commands.command(aliases=['cc'])
+    @commands.has_permissions(manage_messages=True)
+    async def cancelclear(self, ctx):
+        '''Cancels the clear running in this channel'''
+
+        job = self.purge_jobs.get(ctx.channel.id)
+        if not job:
+            return await ctx.send('No clear is running here')
+        job.cancel()
+
+    def export_state(self):
+        '''Hands the running purge jobs over to the reloaded cog (see Owner.reload)'''
+        self.exported = True
+        return {'purge_jobs': self.purge_jobs, 'audit_ready': self.audit_ready}
+
+    def import_state(self, state):
+        '''Takes over the state of the cog this one replaced'''
+        self.purge_jobs = state['purge_jobs']
+        self.audit_ready = state['audit_ready']
+
+    def cog_unload(self):
+        '''Stops the running purge jobs when the cog is unloaded for good'''
+        if self.exported:
+            return
+        for job in self.purge_jobs.values():
+            job.cancel()
 
-        await ctx.channel.purge(limit=amount + 1, check=lambda msg: not msg.pinned)
-        # Checks if the message is pinned; if not -
-        # - it deletes the amount given by user plus the command message itself (Band B.1)
-        await ctx.send(f'{amount} messages were deleted')
+    @commands.Cog.listener()
+    async def on_guild_data_purge(self, guild_id):
+        '''Stops the purges still running in a guild the bot has left (see cleanup.py)'''
+        for channel_id, job in list(self.purge_jobs.items()):
+            if job.channel.guild.id == guild_id:
+                job.cancel()
+                self.purge_jobs.pop(channel_id, None)
 
     @kick.error
     @ban.error
+    @massban.error
+    @masskick.error
     @clear.error
     async def _error(self, ctx, error):
         '''Runs when the prefix error is raised'''
@@ -1,7 +1,7 @@
 '''
 owner.py is the cog that encapsulates all the commands the owner
 of a given Discord guild (server) would use
-The commands are: prefix, reload
+The commands are: prefix, reload, profile, levels
 
 Band A:
 /1. Dynamic generation of objects based on complex user-defined use of OOP model;
@@ -19,11 +19,16 @@ Key:
 Band A.1 = an example of: Dynamic generation of objects...
 '''
 
-import json
 import os
+import time
+import discord
 from discord.ext import commands
+from profiler import LoopProfiler
+from storage import wait_until_open
 # (Band A.4)
 
+UPLOAD_LIMIT = 8 * 1024 * 1024  # Bytes Discord lets the bot upload
+
 async def is_guild_owner(ctx):
     '''Checks if the user is the guild owner'''
     return ctx.author.id == ctx.guild.owner.id
@@ -40,32 +45,139 @@ class Owner(commands.Cog):
     async def prefix(self, ctx, *, pre):
         '''Changes the bot's prefix within a guild'''
 
-        file_path = os.path.dirname(__file__)
-        prefix_file = os.path.join(file_path + "\\..\\data\\prefixes.json")
-        with open(prefix_file, 'r') as _f:
-            prefixes = json.load(_f)
-        # Loads the prefixes json file, for the bot to assign the guild to (Band )
+        if len(pre) > 10:
+            raise commands.BadArgument('Prefix is too long')
+        await wait_until_open(self.bot)     # A change made before the settings load would be lost
+        await self.bot.settings.update(ctx.guild.id, prefix=pre)
+        # Saved to the guild's settings, which get_prefix reads from memory (Band A.5)
 
-        pre = prefixes[(ctx.guild.id)]  # Checks the prefix assigned to the guild
         msg = await ctx.send(f'Guild prefix is `{pre}`')
         await msg.pin() # Pins the message to the channel
 
-        with open(prefix_file, 'w') as _f:
-            json.dump(prefixes, _f, indent=4)
-
     @commands.command(aliases=['r'])
     @commands.check(is_guild_owner)
     async def reload(self, ctx, cog):
-        '''Reloads a given cog within discord'''
+        '''
+        Reloads a given cog within discord, keeping its state.
+        A cog can define export_state() and import_state(state) to hand
+        its playlists, caches etc. over to the reloaded copy of itself
+        '''
+
+        extension = cog if cog in self.bot.extensions else f'cogs.{cog}'
+        # Extensions outside the cogs folder (e.g. music) are reloaded by their own name
+        start = time.perf_counter()
 
         try:
-            self.bot.unload_extension(f'cogs.{cog}') 
-            self.bot.load_extension(f'cogs.{cog}')
-            await ctx.send(f'```{cog} was reloaded```')
+            states = {
+                name: old.export_state()
+                for name, old in self.bot.cogs.items()
+                if old.__module__ == extension and hasattr(old, 'export_state')
+            }   # Exporting also tells the old cog not to tear its state down on unload
         except Exception as _e:
             await ctx.send(f'```{cog} cannot be loaded```')
             raise _e
 
+        failed = None
+        try:
+            self.bot.reload_extension(extension)
+        except Exception as _e:
+            failed = _e
+            # reload_extension rolls back to the old module, whose cogs then take the state back
+
+        lost = []
+        for name, state in states.items():
+            new = self.bot.get_cog(name)
+            if new and hasattr(new, 'import_state'):
+                new.import_state(state)
+            else:
+                lost.append(name)
+
+        if lost:
+            await ctx.send(f"```The state of {', '.join(lost)} was lost```")
+        if failed:
+            await ctx.send(f'```{cog} cannot be loaded, the old version is still running```')
+            raise failed
+
+        text = self.bot.get_cog('Text')
+        if text:
+            text.invalidate_help()
+        # The cached help pages are rebuilt to match the reloaded commands
+        took = (time.perf_counter() - start) * 1000
+        await ctx.send(f'```{cog} was reloaded in {took:.1f}ms```')
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def profile(self, ctx, action='report', threshold_ms: int = None):
+        '''
+        Profiles the event loop, for the bot's owner only:
+        "r-profile start [threshold ms]", "r-profile stop", "r-profile report",
+        "r-profile dump" sends the samples as a flamegraph-ready file
+        '''
+
+        if not getattr(self.bot, 'profiler', None):
+            self.bot.profiler = LoopProfiler(self.bot.loop)
+        profiler = self.bot.profiler
+
+        if action == 'start':
+            profiler.start(threshold_ms / 1000 if threshold_ms else None)
+            await ctx.send(f'```Profiling, threshold {profiler.threshold * 1000:.0f}ms```')
+        elif action == 'stop':
+            profiler.stop()
+            await ctx.send(f'```{profiler.report()}```')
+        elif action == 'report':
+            await ctx.send(f'```{profiler.report()}```')
+        elif action == 'dump':
+            path = profiler.dump(os.path.join(os.path.dirname(__file__), '..', 'data', 'profile.folded'))
+            await ctx.send('Open with flamegraph.pl or https://www.speedscope.app',
+                           file=discord.File(path))
+        else:
+            raise commands.BadArgument(f'Unknown profile action `{action}`')
+
+    @commands.command(hidden=True)
+    @commands.is_owner()
+    async def levels(self, ctx, action, scope='guild'):
+        '''
+        Exports or imports level data, for the bot's owner only:
+        "r-levels export [guild|all]" sends a csv of this guild's (or every guild's) levels,
+        "r-levels import [guild|all]" with a csv attached loads one, replacing the xp
+        and level of members already there, so importing it twice changes nothing.
+        Bigger moves can use levels_io.py from the command line
+        '''
+
+        if scope not in ('guild', 'all'):
+            raise commands.BadArgument('Choose `guild` or `all`')
+        if scope == 'guild' and not ctx.guild:
+            raise commands.NoPrivateMessage('Use `all` in private messages')
+        guild_id = ctx.guild.id if scope == 'guild' else None
+        if action not in ('export', 'import'):
+            raise commands.BadArgument(f'Unknown levels action `{action}`')
+        if action == 'import' and not ctx.message.attachments:
+            raise commands.BadArgument('Attach the csv to import')
+        await wait_until_open(self.bot)
+
+        folder = os.path.join(os.path.dirname(__file__), '..', 'data', 'exports')
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"levels-{guild_id or 'all'}-{int(time.time())}.csv")
+        start = time.perf_counter()
+
+        try:
+            if action == 'export':
+                rows = await self.bot.levels.export_users(path, guild_id=guild_id)
+                took = (time.perf_counter() - start) * 1000
+                if os.path.getsize(path) < UPLOAD_LIMIT:
+                    await ctx.send(f'```Exported {rows} rows in {took:.0f}ms```', file=discord.File(path))
+                else:
+                    await ctx.send(f'```Exported {rows} rows in {took:.0f}ms, too big to upload: '
+                                   f'use "python levels_io.py export" on the server```')
+            else:
+                await ctx.message.attachments[0].save(path)
+                rows = await self.bot.levels.import_users(path, guild_id=guild_id)
+                took = (time.perf_counter() - start) * 1000
+                await ctx.send(f'```Imported {rows} rows in {took:.0f}ms```')
+        finally:
+            if os.path.exists(path):
+                os.remove(path)     # Only ever needed for the upload or the import
+
     @prefix.error
     async def _prefix_error(self, ctx, error):
         '''Runs when the prefix error is raised'''
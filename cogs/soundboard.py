@@ -0,0 +1,197 @@
+'''
+soundboard.py is the cog that plays short sound effects in voice channels.
+A clip is decoded by FFmpeg once, when it is added, into raw PCM in
+data/soundboard/<guild id>/<name>.pcm; the voice workers memory-map it (see voice_worker.py),
+so playing it costs no process and no decode.
+If music is playing, the clip is mixed over it instead of interrupting it.
+The commands are: sound (add, remove, list)
+
+Band A:
+/1. Dynamic generation of objects based on complex user-defined use of OOP model;
+/2. Server-side scripting using request and response objects;
+/3. Files organised for direct access
+
+Key:
+Band A.1 = an example of: Dynamic generation of objects...
+'''
+
+import asyncio
+import ipaddress
+import os
+import re
+import shutil
+import socket
+import subprocess
+import urllib.parse
+import discord
+from discord.ext import commands
+from voice_worker import CHANNELS, SAMPLE_RATE, WorkerSession, get_pool
+
+SOUNDBOARD_PATH = os.path.join(os.path.dirname(__file__), '..', 'data', 'soundboard')
+MAX_CLIP_SECONDS = 10   # Longer sources are cut off when they are decoded
+MAX_CLIPS = 50          # Clips a guild can keep
+CLIP_NAME = re.compile(r'[\w-]{1,32}')
+
+def check_source(url):
+    '''
+    Raises ValueError unless url is a https url of a public host.
+    Anything else (local files, file:/concat: and other FFmpeg protocols, internal hosts)
+    must never reach FFmpeg
+    '''
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme != 'https' or not parts.hostname:
+        raise ValueError('Only https urls can be added')
+    for *_, address in socket.getaddrinfo(parts.hostname, parts.port or 443):
+        if not ipaddress.ip_address(address[0]).is_global:
+            raise ValueError('The url is not on a public host')
+
+def decode_clip(source, path):
+    '''Decodes source (a https url, checked by check_source) into raw PCM at path, in the format the workers play'''
+    subprocess.run(
+        ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-protocol_whitelist', 'https,tls,tcp', '-i', source, '-t', str(MAX_CLIP_SECONDS),
+         '-vn', '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', str(CHANNELS), path + '.tmp'],
+        check=True, timeout=60
+    )
+    if not os.path.getsize(path + '.tmp'):
+        os.remove(path + '.tmp')
+        raise ValueError('The source has no audio')
+    os.replace(path + '.tmp', path)
+    # Written then renamed, so a worker never maps half a clip
+
+def playing_session(source):
+    '''The worker session behind a voice client's source, if it has one'''
+    if isinstance(source, WorkerSession):
+        return source
+    return getattr(source, 'session', None)
+
+class Soundboard(commands.Cog):
+    '''Encapsulates the soundboard commands in the Soundboard class (Band A.1)'''
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def clip_path(self, guild_id, name):
+        '''
+        The file of a guild's clip. Names are checked here, so no command can
+        reach a file outside the guild's own folder (e.g. "../<other guild>/<clip>")
+        '''
+        if not CLIP_NAME.fullmatch(name):
+            raise commands.BadArgument('Sound names are up to 32 letters, numbers, - or _')
+        folder = os.path.realpath(os.path.join(SOUNDBOARD_PATH, str(guild_id)))
+        path = os.path.realpath(os.path.join(folder, f'{name.lower()}.pcm'))
+        if os.path.dirname(path) != folder:
+            raise commands.BadArgument(f'There is no sound called `{name}`')
+        return path
+
+    def clip_names(self, guild_id):
+        folder = os.path.join(SOUNDBOARD_PATH, str(guild_id))
+        if not os.path.isdir(folder):
+            return []
+        return sorted(name[:-4] for name in os.listdir(folder) if name.endswith('.pcm'))
+
+    @commands.Cog.listener()
+    async def on_guild_data_purge(self, guild_id):
+        '''Deletes the clips of a guild the bot has left (see cleanup.py)'''
+        folder = os.path.join(SOUNDBOARD_PATH, str(guild_id))
+        if os.path.isdir(folder):
+            for name in os.listdir(folder):
+                get_pool().unload_clip(os.path.realpath(os.path.join(folder, name)))
+            await self.bot.loop.run_in_executor(None, shutil.rmtree, folder, True)
+
+    def resume_music(self, guild_id):
+        '''Starts the music queued while a clip played on its own'''
+        music = self.bot.get_cog('Music')
+        state = music.music_states.get(guild_id) if music else None
+        if state and not state.playlist.empty() and not state.is_playing():
+            asyncio.run_coroutine_threadsafe(state.play_next_song(), self.bot.loop)
+
+    @commands.group(aliases=['sb'], invoke_without_command=True)
+    @commands.guild_only()
+    async def sound(self, ctx, name: str = None):
+        '''Plays a soundboard clip, over the music if any is playing, e.g. "r-sound airhorn"'''
+
+        if name is None:
+            return await ctx.invoke(self.list_sounds)
+        path = self.clip_path(ctx.guild.id, name)
+        if not os.path.exists(path):
+            raise commands.BadArgument(f'There is no sound called `{name}`')
+
+        voice = ctx.voice_client
+        if voice and voice.is_paused():
+            raise commands.BadArgument('Resume the music to play sounds over it')
+            # Playing the clip on its own would replace the paused song, and lose it
+        if voice and voice.is_playing():
+            session = playing_session(voice.source)
+            if not session:
+                raise commands.BadArgument('Sounds cannot be mixed over what is playing')
+            session.overlay(path)   # Mixed in by the worker, the music carries on
+            return await ctx.message.add_reaction('\N{SPEAKER WITH THREE SOUND WAVES}')
+
+        if voice is None:
+            if not ctx.author.voice:
+                raise commands.BadArgument('Join a voice channel first')
+            voice = await ctx.author.voice.channel.connect()
+            music = self.bot.get_cog('Music')
+            if music:
+                music.get_music_state(ctx.guild.id).voice_client = voice
+            # So the music cog plays through this connection instead of opening another
+
+        voice.play(get_pool().open(path, volume=1.0, raw=True),
+                   after=lambda e: self.resume_music(ctx.guild.id))
+        await ctx.message.add_reaction('\N{SPEAKER WITH THREE SOUND WAVES}')
+
+    @sound.command(name='add')
+    @commands.has_permissions(manage_guild=True)
+    async def add_sound(self, ctx, name: str, url: str = None):
+        '''Adds a clip from an attached file or a url, e.g. "r-sound add airhorn <url>"'''
+
+        path = self.clip_path(ctx.guild.id, name)   # Checks the name
+        source = url or (ctx.message.attachments[0].url if ctx.message.attachments else None)
+        if not source:
+            raise commands.BadArgument('Attach a sound file or give its url')
+        if name.lower() not in self.clip_names(ctx.guild.id) and len(self.clip_names(ctx.guild.id)) >= MAX_CLIPS:
+            raise commands.BadArgument(f'A guild can only keep {MAX_CLIPS} sounds')
+
+        try:
+            await self.bot.loop.run_in_executor(None, check_source, source)    # Resolves the host
+        except (ValueError, OSError):
+            raise commands.BadArgument('Give a https link to the sound, or attach it')
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        async with ctx.typing():
+            try:
+                await self.bot.loop.run_in_executor(None, decode_clip, source, path)
+                # The one FFmpeg run the clip will ever need, off the event loop
+            except (subprocess.SubprocessError, ValueError, OSError):
+                raise commands.BadArgument(f'`{name}` could not be decoded')
+        get_pool().unload_clip(path)    # Workers that mapped an older clip of that name reload it
+        await ctx.send(f'```Added sound {name.lower()}```')
+
+    @sound.command(name='remove', aliases=['delete'])
+    @commands.has_permissions(manage_guild=True)
+    async def remove_sound(self, ctx, name: str):
+        '''Removes a clip'''
+
+        path = self.clip_path(ctx.guild.id, name)
+        if not os.path.exists(path):
+            raise commands.BadArgument(f'There is no sound called `{name}`')
+        get_pool().unload_clip(path)
+        try:
+            os.remove(path)
+        except OSError:
+            # Windows won't delete a file a worker still has mapped; it is free once the clip ends
+            await asyncio.sleep(MAX_CLIP_SECONDS)
+            os.remove(path)
+        await ctx.send(f'```Removed sound {name.lower()}```')
+
+    @sound.command(name='list')
+    async def list_sounds(self, ctx):
+        '''Lists the guild's clips'''
+
+        names = self.clip_names(ctx.guild.id)
+        await ctx.send(f"```Sounds: {', '.join(names) if names else 'none yet, add one with r-sound add'}```")
+
+def setup(bot):
+    '''Entry point to the "r_bot.py" file (Band B.1)'''
+    bot.add_cog(Soundboard(bot))
+    # Registers the "soundboard.py" cog to the bot
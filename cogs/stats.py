@@ -0,0 +1,131 @@
+'''
+stats.py is the cog that measures how the bot performs and shows it,
+both to users (the stats command) and to Prometheus, through a small
+HTTP endpoint at http://127.0.0.1:9100/metrics (9100 + worker number under launcher.py).
+The events are: on_command, on_command_completion, on_command_error
+The commands are: stats
+
+Band A:
+/1. Dynamic generation of objects based on complex user-defined use of OOP model;
+/2. Server-side scripting using request and response objects;
+/3. Server-side extensions for a complex client-server model
+
+Key:
+Band A.1 = an example of: Dynamic generation of objects...
+'''
+
+import asyncio
+import time
+import discord
+from aiohttp import web
+from discord.ext import commands
+import metrics
+
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9100
+LAG_INTERVAL = 0.5  # Seconds between event loop lag samples
+
+class Stats(commands.Cog):
+    '''Encapsulates the metrics listeners, endpoint and command in the Stats class (Band A.1)'''
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.runner = None
+        self.lag_task = bot.loop.create_task(self.measure_lag())
+        self.server_task = bot.loop.create_task(self.start_server())
+
+    def cog_unload(self):
+        self.lag_task.cancel()
+        self.server_task.cancel()
+        if self.runner:
+            self.bot.loop.create_task(self.runner.cleanup())
+
+    async def measure_lag(self):
+        '''Sleeps for LAG_INTERVAL and records how much later than asked it woke up'''
+        loop = self.bot.loop
+        while True:
+            start = loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            lag = max(0.0, loop.time() - start - LAG_INTERVAL)
+            metrics.LOOP_LAG.set(lag)
+            metrics.LOOP_LAG_HISTOGRAM.observe(lag)
+
+    async def start_server(self):
+        '''Serves the metrics over HTTP (Band A.2)'''
+        app = web.Application()
+        app.router.add_get('/metrics', self.serve_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        port = METRICS_PORT + (getattr(self.bot, 'worker', None) or 0)
+        for _ in range(5):
+            try:
+                return await web.TCPSite(self.runner, METRICS_HOST, port).start()
+            except OSError:
+                await asyncio.sleep(1)  # The cog this one replaced may still be closing the port
+
+    def update_gauges(self):
+        '''Reads the gauges that are cheaper to look up than to track'''
+        metrics.VOICE_CLIENTS.set(len(self.bot.voice_clients))
+        metrics.GUILDS.set(len(self.bot.guilds))
+        pool = self.bot.pg_con
+        if pool:
+            metrics.DB_POOL_SIZE.set(pool.get_size())
+            metrics.DB_POOL_IN_USE.set(pool.get_size() - pool.get_idle_size())
+        for phase, seconds in self.bot.startup_timings.items():
+            metrics.STARTUP.set(seconds, phase)
+
+    async def serve_metrics(self, request):
+        self.update_gauges()
+        return web.Response(text=metrics.render(), content_type='text/plain')
+
+    @commands.Cog.listener()
+    async def on_command(self, ctx):
+        ctx.started_at = time.perf_counter()
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx):
+        metrics.COMMANDS.inc(ctx.command.qualified_name, 'ok')
+        metrics.COMMAND_LATENCY.observe(time.perf_counter() - ctx.started_at, ctx.command.qualified_name)
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        if ctx.command and hasattr(ctx, 'started_at'):
+            metrics.COMMANDS.inc(ctx.command.qualified_name, 'error')
+            metrics.COMMAND_LATENCY.observe(time.perf_counter() - ctx.started_at, ctx.command.qualified_name)
+
+    @commands.command(aliases=['st'])
+    async def stats(self, ctx):
+        '''Shows how the bot is performing'''
+
+        self.update_gauges()
+        embed = discord.Embed(title='Stats', colour=discord.Colour.blue(), timestamp=ctx.message.created_at)
+
+        embed.add_field(name='Gateway latency', value=f'{self.bot.latency * 1000:.0f}ms')
+        embed.add_field(name='Event loop lag', value=f'{metrics.LOOP_LAG.get() * 1000:.1f}ms')
+        embed.add_field(name='Voice connections', value=metrics.VOICE_CLIENTS.get())
+        embed.add_field(name='DB pool in use', value=f'{metrics.DB_POOL_IN_USE.get()}/{metrics.DB_POOL_SIZE.get()}')
+        embed.add_field(name='youtube_dl queue', value=metrics.YTDL_QUEUE.get())
+        embed.add_field(name='Guilds', value=metrics.GUILDS.get())
+
+        histogram = metrics.COMMAND_LATENCY
+        busiest = sorted(histogram.values, key=lambda labels: -histogram.count(*labels))[:10]
+        lines = [
+            f'{name}: {histogram.count(name)} runs, mean {histogram.mean(name) * 1000:.0f}ms, '
+            f'p99 <{histogram.quantile(0.99, name) * 1000:.0f}ms'
+            for (name,) in busiest
+        ]
+        embed.add_field(name='Commands', value='\n'.join(lines) or 'None yet', inline=False)
+
+        listeners = metrics.LISTENER_LATENCY
+        lines = [
+            f'{name}: {listeners.count(name)} runs, mean {listeners.mean(name) * 1000:.1f}ms'
+            for (name,) in sorted(listeners.values)
+        ]
+        embed.add_field(name='Listeners', value='\n'.join(lines) or 'None yet', inline=False)
+
+        await ctx.send(embed=embed)
+
+def setup(bot):
+    '''Entry point to the "r_bot.py" file (Band B.1)'''
+    bot.add_cog(Stats(bot))
+    # Registers the "stats.py" cog to the bot
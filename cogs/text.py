@@ -17,12 +17,18 @@ Generation of objects based on simple OOP model
 
 import discord
 from discord.ext import commands
+from paginator import build_pages, paginate, truncate
+from storage import wait_until_open
+
+HELP_PAGE_SIZE = 10 # Fields per help page, Discord allows 25 at most
 
 class Text(commands.Cog):
     '''Encapsulates all text commands in the Text class'''
 
     def __init__(self, bot):
         self.bot = bot
+        self.help_pages = None  # Built on the first "r-help", see build_help
+        self.help_index = {}    # Maps each command name and alias to its help embed
 
     @commands.command(aliases=['p'])
     # Aliases are shortcuts to the commands e.g. "r-ping" ≡ "r-p"
@@ -45,21 +51,55 @@ class Text(commands.Cog):
 
         await ctx.send(message)
 
+    def invalidate_help(self):
+        '''Drops the cached help so it is rebuilt after a cog is (re)loaded'''
+        self.help_pages = None
+        self.help_index = {}
+
+    def build_help(self):
+        '''
+        Builds the help pages and the command lookup index once,
+        instead of creating a new embed on every "r-help"
+        '''
+
+        cmds = sorted(
+            (cmd for cmd in self.bot.commands if not cmd.hidden),
+            key=lambda cmd: cmd.qualified_name
+        )   # Hidden commands (e.g. prefix) stay out of the list
+
+        fields = [(cmd.qualified_name, f'{cmd.aliases}: {cmd.help}') for cmd in cmds]
+        self.help_pages = build_pages('Help commands:', fields, per_page=HELP_PAGE_SIZE)
+
+        self.help_index = {}
+        for cmd in cmds:
+            embed = discord.Embed(
+                title=f'{cmd.qualified_name} {cmd.signature}',
+                description=truncate(cmd.help, 2048),
+                colour=discord.Colour.blue()
+            )
+            if cmd.aliases:
+                embed.add_field(name='Aliases', value=', '.join(cmd.aliases))
+            for name in [cmd.qualified_name] + list(cmd.aliases):
+                self.help_index[name] = embed
+            # Every alias points to the same embed, so "r-help p" works like "r-help ping"
+
     @commands.command(aliases=['h'])
-    async def help(self, ctx):
-        '''Sends an embedded PM to the user of a list of commands'''
+    async def help(self, ctx, *, command: str = None):
+        '''
+        Sends an embedded PM to the user of a list of commands
+        i.e. "r-help ping" only shows the help of the ping command
+        '''
 
-        embed = discord.Embed(
-            title='Help commands:',
-            colour=ctx.author.color,
-            timestamp=ctx.message.created_at
-        )
+        if self.help_pages is None:
+            self.build_help()
 
-        embed.set_author(name='Help', icon_url=ctx.author.avatar_url)
+        if command:
+            embed = self.help_index.get(command.lower().strip())
+            if not embed:
+                return await ctx.send(f'No command called `{command}` found')
+            return await ctx.author.send(embed=embed)
 
-        for cmds in self.bot.commands: # Creates a field for each command
-            embed.add_field(name=cmds, value=f'{cmds.aliases}: {cmds.help}', inline=False)
-        await ctx.author.send(embed=embed)
+        await paginate(self.bot, ctx.author, ctx.author, self.help_pages)
 
     @commands.command(aliases=['de'])
     async def display_embed(self, ctx):
@@ -88,35 +128,10 @@ class Text(commands.Cog):
         # Makes member argument the user if it isn't given
         roles = [role for role in member.roles]
         # Makes a list of member roles a user has
+        await wait_until_open(self.bot)
 
-        user = await self.bot.pg_con.fetchrow(
-            """
-            SELECT *
-            FROM users
-            WHERE user_id = $1 AND guild_id = $2
-            """,
-            member.id, member.guild.id
-        )
-        # Get's the user's record
-
-        if not user: # Creates a new user if user is returned false
-            user = await self.bot.pg_con.fetchrow(
-                """
-                INSERT INTO users (user_id, guild_id)
-                VALUES ($1, $2)
-                RETURNING *
-                """,
-                member.id, member.guild.id
-            )
-
-        await self.bot.pg_con.execute(
-            """
-            UPDATE users
-            SET xp = $1
-            WHERE user_id = $2 AND guild_id = $3
-            """,
-            user['xp'], member.id, member.guild.id
-        )
+        user = await self.bot.levels.get_user(member.id, member.guild.id)
+        # Get's the user's record, creating it if the user doesn't have one
 
         embed = discord.Embed(
             colour=member.colour,
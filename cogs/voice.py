@@ -1,7 +1,9 @@
 '''
 voice.py is the cog that encapsulates all the commands a standard user
 of a given Discord guild voice channel would use.
-The commands are: join, play, yt, stream, volume, pause, resume, stop
+The commands are: yt, stream
+Joining, the playlist, pausing, resuming, stopping and the volume are
+commands of the music extension (music.py), which plays through the same voice client
 
 NB: This script is from: https://github.com/Rapptz/discord.py/blob/rewrite/examples/basic_voice.py
     and I modified is appropriately to work with my bot specifically
@@ -20,16 +22,16 @@ Generation of objects based on simple OOP model
 '''
 
 import asyncio
+import functools
+import subprocess
 import discord
 from discord.ext import commands
-import youtube_dl
+from music import (ANALYSES, EXTRACTIONS, hold_file, loudness_gain, normalize_query, release_file,
+                   run_ytdl, track_loudness)
+from voice_worker import get_pool
 
 # ------------------------- Voice channel -------------------------
 
-# Suppress noise about console usage from errors
-youtube_dl.utils.bug_reports_message = lambda: ''
-
-
 ytdl_format_options = {
     'format': 'bestaudio/best',
     'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
@@ -45,36 +47,96 @@ ytdl_format_options = {
     # Makes all connections via IPv4
 }
 
-ffmpeg_options = {
-    'options': '-vn'
-}
-
-ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+_ytdl = None
+
+def get_ytdl():
+    '''
+    Imports youtube_dl and builds the downloader on the first command that needs it,
+    since importing youtube_dl is the slowest part of loading the cogs
+    '''
+    global _ytdl
+    if _ytdl is None:
+        import youtube_dl
+        youtube_dl.utils.bug_reports_message = lambda: ''
+        # Suppress noise about console usage from errors
+        _ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+    return _ytdl
 
 # ------------------------- Voice cog -------------------------
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    '''Gets the youtube source from the url'''
-
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
+class YTDLSource(discord.AudioSource):
+    '''
+    Gets the youtube source from the url.
+    The audio is decoded and encoded in a voice worker process (see voice_worker.py)
+    and only the finished Opus packets are read here.
+    A downloaded file is held (see music.hold_file) while it plays, and its loudness
+    gain is folded into the worker's volume once it is measured, as for playlist songs
+    '''
+
+    def __init__(self, filename, *, data, volume=0.5, stream=False):
+        self._volume = volume
+        self.gain = 1.0
+        self.filename = None if stream else filename
+        if self.filename:
+            hold_file(self.filename)
+        self.session = get_pool().open(filename, volume, stream=stream)
 
         self.data = data
 
         self.title = data.get('title')
         self.url = data.get('url')
 
+    def read(self):
+        return self.session.read()
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.session.cleanup()
+        if self.filename:
+            release_file(self.filename)
+            self.filename = None
+
+    async def normalize(self, loop):
+        '''Measures the downloaded file's loudness (once per file, see music.track_loudness) and applies the gain'''
+        filename = self.filename
+        if not filename:
+            return  # Streams are played at their own loudness, there is no file to measure
+        try:
+            loudness = await ANALYSES.run(filename, functools.partial(track_loudness, filename, loop))
+        except (OSError, ValueError, subprocess.SubprocessError):
+            return
+        self.gain = loudness_gain(loudness)
+        if self.filename:   # Not finished while it was measured
+            self.session.volume = self._volume * self.gain
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+        self.session.volume = value * self.gain
+
     @classmethod
     async def from_url(cls, url, *, loop=None, stream=False):
         loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+        key = ('stream' if stream else 'download', normalize_query(url))
+        data = await EXTRACTIONS.run(key, lambda: run_ytdl(loop, lambda: get_ytdl().extract_info(url, download=not stream)))
+        # The same url asked for at once is extracted (and downloaded) only once
+        if data is None:
+            raise commands.CommandError(f'Could not retrieve info from {url}')
 
         if 'entries' in data:
             # take first item from a playlist
             data = data['entries'][0]
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
-        return cls(discord.FFmpegPCMAudio(filename, **ffmpeg_options), data=data)
+        filename = data['url'] if stream else get_ytdl().prepare_filename(data)
+        source = cls(filename, data=data, stream=stream)
+        loop.create_task(source.normalize(loop))    # Starts at its own loudness, the gain follows
+        return source
 
 class Voice(commands.Cog):
     '''Encapsulates all the voice commands in the Voice cog'''
@@ -82,27 +144,6 @@ class Voice(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
 
-    @commands.command()
-    async def join(self, ctx, *, channel: discord.VoiceChannel = None):
-        """Joins a voice channel
-        If no channel is given, the bot joins the author's current voice channel"""
-
-        channel = channel or ctx.author.voice.channel
-
-        if ctx.voice_client is not None:
-            return await ctx.voice_client.move_to(destination)
-
-        await destination.connect()
-
-    @commands.command()
-    async def play(self, ctx, *, query):
-        """Plays a file from the local filesystem"""
-
-        source = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(query))
-        ctx.voice_client.play(source, after=lambda e: print('Player error: %s' % e) if e else None)
-
-        await ctx.send(f'Now playing: {query}')
-
     @commands.command()
     async def yt(self, ctx, *, url):
         """Plays from a url (almost anything youtube_dl supports)"""
@@ -123,42 +164,15 @@ class Voice(commands.Cog):
 
         await ctx.send(f'Now playing: {player.title}')
 
-    @commands.command()
-    async def volume(self, ctx, volume: int):
-        """Changes the player's volume, in the range [0, 100]"""
-
-        if ctx.voice_client is None:
-            return await ctx.send("Not connected to a voice channel.")
-
-        ctx.voice_client.source.volume = volume / 100
-        await ctx.send(f"Changed volume to {volume}%")
-
-    # I created the pause and resume commands
-    # which were not included in the basic_voice.py I modified
-    @commands.command()
-    async def pause(self, ctx):
-        """Pauses the player."""
-
-        if ctx.voice_client:
-            ctx.voice_client.pause()
-
-    @commands.command()
-    async def resume(self, ctx):
-        """Resumes the player."""
-
-        if ctx.voice_client:
-            ctx.voice_client.resume()
-
-    @commands.command()
-    async def stop(self, ctx):
-        """Stops the song playing and disconnects the bot from the channel"""
-
-        await ctx.voice_client.disconnect()
-
-    @play.before_invoke
     @yt.before_invoke
     @stream.before_invoke
     async def ensure_voice(self, ctx):
+        music = self.bot.get_cog('Music')
+        state = music.music_states.get(ctx.guild.id) if music and ctx.guild else None
+        if state and state.is_playing():
+            raise commands.CommandError('The playlist is playing, use r-play to queue this or r-stop first')
+            # Stopping the playlist's song here would start its next one over this
+
         if ctx.voice_client is None:
             if ctx.author.voice:
                 await ctx.author.voice.channel.connect()
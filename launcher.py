@@ -0,0 +1,194 @@
+'''
+launcher.py runs R-bot over several processes so it can use more than one CPU core.
+Each worker process runs r_bot.py with its own range of shards
+(and so its own event loop, database pool and caches).
+The launcher supervises the workers, restarting any that crash or stop
+reporting their health, and prints a summary of every shard's health.
+Workers are started one after another, each once the shards before it
+have had time to identify, since Discord only lets one shard identify at a time.
+
+Usage:
+    python launcher.py                  # one process, auto-sharded
+    python launcher.py --workers 4      # 4 processes, shard count asked from Discord
+    python launcher.py --workers 4 --shards 16
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+
+FILE_PATH = os.path.dirname(os.path.abspath(__file__))
+TOKEN_FILE = os.path.join(FILE_PATH, 'data', 'token.txt')
+HEALTH_DIR = os.path.join(FILE_PATH, 'data', 'health')
+BOT_SCRIPT = os.path.join(FILE_PATH, 'r_bot.py')
+
+CHECK_INTERVAL = 5      # Seconds between checks on the workers
+STALE_AFTER = 120       # A worker that hasn't reported for this long is restarted
+IDENTIFY_TIME = 5       # Seconds Discord needs between two shards identifying
+REPORT_INTERVAL = 60    # Seconds between health summaries
+MAX_BACKOFF = 60        # Longest wait before restarting a crashing worker
+STABLE_AFTER = 300      # A worker up this long has its backoff reset
+
+def recommended_shards():
+    '''Asks Discord how many shards the bot should use'''
+    with open(TOKEN_FILE, 'r') as _f:
+        token = _f.read().strip()
+    request = urllib.request.Request(
+        'https://discord.com/api/v9/gateway/bot',
+        headers={'Authorization': f'Bot {token}', 'User-Agent': 'R-bot launcher'}
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)['shards']
+
+def split_shards(shard_count, workers):
+    '''Splits the shards into contiguous ranges, e.g. (10, 3) -> ["0-3", "4-6", "7-9"]'''
+    ranges = []
+    start = 0
+    for worker in range(workers):
+        size = shard_count // workers + (1 if worker < shard_count % workers else 0)
+        if size:
+            ranges.append(f'{start}-{start + size - 1}')
+        start += size
+    return ranges
+
+class Worker:
+    '''One supervised r_bot.py process'''
+
+    def __init__(self, number, args):
+        self.number = number
+        self.args = args
+        self.process = None
+        self.started = 0
+        self.backoff = 1
+        self.restart_at = 0
+
+    @property
+    def shards(self):
+        '''How many shards the worker runs (1 if it auto-shards and hasn't said yet)'''
+        if '--shard-ids' in self.args:
+            first, _, last = self.args[self.args.index('--shard-ids') + 1].partition('-')
+            return int(last or first) - int(first) + 1
+        health = self.health()
+        return len(health['shards']) if health and health['shards'] else 1
+
+    @property
+    def connect_time(self):
+        '''Seconds the worker may take to identify all of its shards'''
+        return IDENTIFY_TIME * self.shards
+
+    @property
+    def health_file(self):
+        return os.path.join(HEALTH_DIR, f'worker-{self.number}.json')
+
+    def start(self):
+        '''Starts (or restarts) the process'''
+        try:
+            os.remove(self.health_file)
+        except OSError:
+            pass
+        self.process = subprocess.Popen([sys.executable, BOT_SCRIPT, '--worker', str(self.number)] + self.args,
+                                        cwd=FILE_PATH)
+        self.started = time.time()
+        print(f"{time.strftime('%X')}: worker {self.number} started (pid {self.process.pid})")
+
+    def health(self):
+        '''Reads the last health report of the worker, None if there isn't one'''
+        try:
+            with open(self.health_file, 'r') as _f:
+                return json.load(_f)
+        except (OSError, ValueError):
+            return None
+
+    def check(self, now):
+        '''Restarts the worker if it exited or stopped reporting, with an increasing backoff'''
+        if self.process is None:
+            if now >= self.restart_at:
+                self.start()
+            return
+
+        health = self.health()
+        last_seen = health['time'] if health else self.started
+        stale_after = STALE_AFTER
+        if not health or health.get('status') == 'connecting':
+            stale_after += self.connect_time
+            # Still identifying its shards, which takes longer the more shards it has
+            if health and now - self.started >= stale_after:
+                last_seen = self.started  # Reports, but never got ready
+        if self.process.poll() is None and now - last_seen < stale_after:
+            if now - self.started > STABLE_AFTER:
+                self.backoff = 1
+            return
+
+        if self.process.poll() is None:
+            print(f"{time.strftime('%X')}: worker {self.number} stopped reporting, restarting it")
+            self.stop()
+        else:
+            print(f"{time.strftime('%X')}: worker {self.number} exited with {self.process.returncode}")
+
+        self.process = None
+        self.restart_at = now + self.backoff
+        self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+
+    def stop(self):
+        '''Terminates the process, killing it if it doesn't exit in time'''
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+def report(workers):
+    '''Prints the gathered health of every shard'''
+    print(f"{time.strftime('%X')}: health")
+    for worker in workers:
+        health = worker.health()
+        if not health:
+            print(f'    worker {worker.number}: no report yet')
+            continue
+        shards = ', '.join(f'{shard}: {latency * 1000:.0f}ms' for shard, latency in health['shards'].items())
+        print(f"    worker {worker.number}: {health['guilds']} guilds, "
+              f"{health['voice_clients']} voice clients, shards [{shards}]")
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs R-bot over several supervised processes')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes')
+    parser.add_argument('--shards', type=int, help='total shards, asked from Discord if not given')
+    args = parser.parse_args()
+
+    if args.workers == 1 and not args.shards:
+        worker_args = [[]]  # One auto-sharded process
+    else:
+        shard_count = args.shards or recommended_shards()
+        worker_args = [['--shard-count', str(shard_count), '--shard-ids', shard_ids]
+                       for shard_ids in split_shards(shard_count, args.workers)]
+
+    os.makedirs(HEALTH_DIR, exist_ok=True)
+    workers = [Worker(number, worker_arg) for number, worker_arg in enumerate(worker_args)]
+    start_at = time.time()
+    for worker in workers:
+        worker.restart_at = start_at   # Started by check, once the workers before it had time to identify
+        start_at += worker.connect_time
+
+    last_report = time.time()
+    try:
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            now = time.time()
+            for worker in workers:
+                worker.check(now)
+            if now - last_report >= REPORT_INTERVAL:
+                report(workers)
+                last_report = now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+'''
+levels_io.py moves level data in and out of the configured level store
+(data/config.json, see storage.py) without going through the bot,
+e.g. to move guilds between deployments or to seed from another bot's data.
+The users table is streamed with COPY on Postgres and row by row on SQLite,
+so memory use doesn't grow with the number of rows. Importing the same file
+twice leaves the same data: imported rows replace the xp and level of existing ones.
+
+The files are CSV with a user_id,guild_id,xp,level header;
+Postgres can also use its binary COPY format (--format binary).
+
+Usage (from the repository root):
+    python levels_io.py export levels.csv                  # every guild
+    python levels_io.py export guild.csv --guild 1234
+    python levels_io.py import levels.csv [--guild 1234]
+'''
+
+import argparse
+import asyncio
+import time
+
+from storage import CONFIG_FILE, load_config, open_levels
+
+async def run(args):
+    pool, levels = await open_levels(load_config(args.config))
+    start = time.perf_counter()
+    try:
+        if args.action == 'export':
+            rows = await levels.export_users(args.file, guild_id=args.guild, format=args.format)
+        else:
+            rows = await levels.import_users(args.file, guild_id=args.guild, format=args.format)
+    finally:
+        await levels.close()
+    print(f'{args.action}ed {rows} rows in {time.perf_counter() - start:.2f}s')
+
+def main():
+    parser = argparse.ArgumentParser(description='Exports or imports the level data')
+    parser.add_argument('action', choices=('export', 'import'))
+    parser.add_argument('file')
+    parser.add_argument('--guild', type=int, help='only this guild (default: all of them)')
+    parser.add_argument('--format', choices=('csv', 'binary'), default='csv', help='binary is Postgres only')
+    parser.add_argument('--config', default=CONFIG_FILE)
+    asyncio.get_event_loop().run_until_complete(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+'''
+metrics.py keeps the bot's performance numbers (command latencies, listener timings,
+event loop lag, ...) and renders them in the Prometheus text format.
+The metrics live in this module rather than in a cog, so they survive cog reloads.
+'''
+
+import bisect
+import functools
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value).replace(chr(34), "")}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+class Metric:
+    '''Base of every metric: a name, a help text and optional label names'''
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}    # label values -> value
+        REGISTRY.append(self)
+
+    def header(self):
+        return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+
+    def render(self):
+        lines = self.header()
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{format_labels(self.labels, labels)} {value}')
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        self.values[labels] = value
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+class Histogram(Metric):
+    '''Counts observations into fixed buckets; each series costs len(buckets) + 2 numbers'''
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels):
+        series = self.values.get(labels)
+        return series[2] if series else 0
+
+    def mean(self, *labels):
+        series = self.values.get(labels)
+        return series[1] / series[2] if series and series[2] else 0.0
+
+    def quantile(self, q, *labels):
+        '''Estimates a quantile as the upper bound of the bucket it falls in'''
+        series = self.values.get(labels)
+        if not series or not series[2]:
+            return 0.0
+        target = q * series[2]
+        running = 0
+        for bound, count in zip(self.buckets, series[0]):
+            running += count
+            if running >= target:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = self.header()
+        for labels, (counts, total, count) in sorted(self.values.items()):
+            running = 0
+            for bound, bucket in zip(self.buckets, counts):
+                running += bucket
+                bucket_labels = format_labels(self.labels + ('le',), labels + (bound,))
+                lines.append(f'{self.name}_bucket{bucket_labels} {running}')
+            inf_labels = format_labels(self.labels + ('le',), labels + ('+Inf',))
+            lines.append(f'{self.name}_bucket{inf_labels} {count}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, labels)} {count}')
+        return lines
+
+REGISTRY = []
+
+COMMANDS = Counter('rbot_commands_total', 'Commands invoked', ('command', 'outcome'))
+COMMAND_LATENCY = Histogram('rbot_command_latency_seconds', 'Time taken by each command', ('command',))
+LISTENER_LATENCY = Histogram('rbot_listener_latency_seconds', 'Time taken by each event listener', ('listener',))
+LOOP_LAG = Gauge('rbot_event_loop_lag_seconds', 'How late the last event loop tick ran')
+LOOP_LAG_HISTOGRAM = Histogram('rbot_event_loop_lag_hist_seconds', 'How late event loop ticks ran')
+DB_POOL_SIZE = Gauge('rbot_db_pool_size', 'Connections open in the database pool')
+DB_POOL_IN_USE = Gauge('rbot_db_pool_in_use', 'Connections of the database pool in use')
+YTDL_QUEUE = Gauge('rbot_ytdl_queue_depth', 'youtube_dl jobs waiting or running in the executor')
+VOICE_CLIENTS = Gauge('rbot_voice_clients', 'Active voice connections')
+GUILDS = Gauge('rbot_guilds', 'Guilds this process serves')
+STARTUP = Gauge('rbot_startup_seconds', 'Time taken by each startup phase', ('phase',))
+
+def timed_listener(name):
+    '''Decorates an event listener so its run time is recorded under name'''
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                LISTENER_LATENCY.observe(time.perf_counter() - start, name)
+        return wrapper
+    return decorator
+
+def render():
+    '''The whole registry in the Prometheus text format'''
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -1,12 +1,173 @@
 import asyncio
+import collections
+import concurrent.futures
 import functools
+import itertools
+import json
 import logging
 import os
 import pathlib
+import re
+import subprocess
+import time
+import urllib.parse
 
 import discord
 import discord.ext.commands as commands
-import youtube_dl
+
+import metrics
+from storage import wait_until_open
+from voice_worker import get_pool
+
+YTDL_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='ytdl')
+# Loudness is measured in its own executor, so it never holds up an extraction or download
+LOUDNESS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='loudness')
+TARGET_LOUDNESS = -16.0     # LUFS every downloaded track is brought to
+MAX_GAIN = 2.0              # The voice workers don't amplify more than this
+MIN_GAIN = 0.1
+RESUME_INTERVAL = 10        # Seconds between saves of what each guild is playing, and where
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+async def run_ytdl(loop, func):
+    # Runs a youtube_dl call in its own executor, counting the calls queued or running
+    metrics.YTDL_QUEUE.inc()
+    try:
+        return await loop.run_in_executor(YTDL_EXECUTOR, func)
+    finally:
+        metrics.YTDL_QUEUE.dec()
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time: callers that ask for a key already
+    in flight await the same call and share its result.
+    A failed call is remembered for negative_ttl seconds, so a bad query isn't retried in a tight loop."""
+    def __init__(self, negative_ttl=30.0, max_failures=1000):
+        self.negative_ttl = negative_ttl
+        self.max_failures = max_failures
+        self.calls = {}         # key -> future of the call in flight
+        self.failures = {}      # key -> (time the failure is forgotten, exception)
+
+    async def run(self, key, func):
+        failure = self.failures.get(key)
+        if failure:
+            if failure[0] > time.monotonic():
+                raise failure[1]
+            del self.failures[key]
+
+        future = self.calls.get(key)
+        if future is None:
+            future = self.calls[key] = asyncio.ensure_future(func())
+            future.add_done_callback(functools.partial(self._done, key))
+        # Shielded, so one caller giving up doesn't cancel the call for the others
+        return await asyncio.shield(future)
+
+    def _done(self, key, future):
+        del self.calls[key]
+        if future.cancelled() or future.exception() is None:
+            return
+        if len(self.failures) >= self.max_failures:
+            now = time.monotonic()
+            self.failures = {k: f for k, f in self.failures.items() if f[0] > now}
+        self.failures[key] = (time.monotonic() + self.negative_ttl, future.exception())
+
+
+EXTRACTIONS = SingleFlight()    # keyed by the normalized query
+DOWNLOADS = SingleFlight()      # keyed by the video id
+
+SEARCH_RESULTS = 5          # Results r-search offers
+SEARCH_TTL = 600            # Seconds a search's results are reused for the same text
+SEARCH_CACHE_SIZE = 256
+SEARCH_TIMEOUT = 30         # Seconds a user has to pick a result
+SEARCH_CACHE = collections.OrderedDict()    # normalized text -> (time it expires, [TrackInfo])
+NUMBER_EMOJIS = [f'{n}\N{VARIATION SELECTOR-16}\N{COMBINING ENCLOSING KEYCAP}' for n in range(1, 10)]
+# Discord sends keycap reactions back with the variation selector, so they must be built with it
+
+# Downloaded files are shared by every playlist entry of the same video, in any guild;
+# a file is only deleted once the last entry using it has been played or cleared
+FILE_REFS = collections.Counter()
+
+
+def hold_file(filename):
+    FILE_REFS[filename] += 1
+
+
+def release_file(filename):
+    FILE_REFS[filename] -= 1
+    if FILE_REFS[filename] > 0:
+        return
+    del FILE_REFS[filename]
+    for path in (filename, filename + LOUDNESS_SUFFIX):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+LOUDNESS_SUFFIX = '.loudness.json'
+ANALYSES = SingleFlight()       # keyed by the file name
+
+
+def measure_loudness(filename):
+    # Integrated loudness (EBU R128) of a whole file in LUFS; blocks, so it runs in LOUDNESS_EXECUTOR
+    result = subprocess.run(
+        ['ffmpeg', '-nostdin', '-hide_banner', '-nostats', '-i', filename, '-vn', '-af', 'ebur128', '-f', 'null', '-'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=300
+    )
+    matches = re.findall(r'I:\s+(-?[\d.]+) LUFS', result.stderr.decode(errors='replace'))
+    if not matches:
+        raise ValueError(f'No loudness measured for {filename}')
+    return float(matches[-1])   # The last one is the summary of the whole file
+
+
+async def track_loudness(filename, loop):
+    # A file's loudness is kept in a sidecar next to it, so it's only measured once per download
+    sidecar = filename + LOUDNESS_SUFFIX
+    try:
+        with open(sidecar, 'r') as f:
+            return json.load(f)['integrated']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    loudness = await loop.run_in_executor(LOUDNESS_EXECUTOR, measure_loudness, filename)
+    if not FILE_REFS[filename] or not os.path.exists(filename):
+        return loudness     # Released (and deleted) while it was measured, so there is nothing to keep it for
+    with open(sidecar, 'w') as f:
+        json.dump({'integrated': loudness, 'target': TARGET_LOUDNESS}, f)
+    return loudness
+
+
+def loudness_gain(loudness):
+    # The fixed gain that brings a track of this loudness to TARGET_LOUDNESS
+    return max(MIN_GAIN, min(MAX_GAIN, 10 ** ((TARGET_LOUDNESS - loudness) / 20)))
+
+
+def parse_position(text, current=0):
+    # "90", "1:30" or "1:02:03" is a time in the song; "+15" and "-10" are relative to current
+    relative = text[:1] if text[:1] in '+-' else ''
+    seconds = 0
+    for part in text.lstrip('+-').split(':'):
+        if not part.isdigit():
+            raise MusicError(f'{text} is not a time, use e.g. 90, 1:30, +15 or -10')
+        seconds = seconds * 60 + int(part)
+    if relative:
+        return current + seconds if relative == '+' else current - seconds
+    return seconds
+
+
+def format_position(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02}:{seconds:02}' if hours else f'{minutes}:{seconds:02}'
+
+
+def normalize_query(query):
+    # Searches that only differ in case or spacing share a key,
+    # but urls are kept as they are: video ids are case-sensitive
+    query = query.strip()
+    if urllib.parse.urlsplit(query).scheme in ('http', 'https') or query.lower().startswith('www.'):
+        return query
+    return ' '.join(query.lower().split())
 
 
 def setup(bot):
@@ -33,16 +194,120 @@ class MusicError(commands.UserInputError):
     pass
 
 
-class Song(discord.PCMVolumeTransformer):
-    def __init__(self, song_info):
-        self.info = song_info.info
+class TrackInfo:
+    """The few fields of a youtube_dl info dict the bot uses.
+    A processed info dict carries every format, thumbnail and subtitle and is often
+    tens of KB; this keeps a few hundred bytes per playlist entry."""
+    __slots__ = ('video_id', 'title', 'creator', 'duration', 'webpage_url', 'url', 'expiry', 'filename',
+                 'gain', '_text', '_duration_text')
+
+    def __init__(self, title, creator, duration=None, webpage_url=None, url=None, expiry=None, filename=None,
+                 video_id=None):
+        self.video_id = video_id
+        self.title = title
+        self.creator = creator
+        self.duration = duration
+        self.webpage_url = webpage_url
+        self.url = url              # Direct stream url, only valid until expiry
+        self.expiry = expiry        # Unix time the stream url stops working, None if unknown
+        self.filename = filename
+        self.gain = None            # Loudness normalization factor, once the file has been measured
+        self._text = None
+        self._duration_text = None
+
+    @classmethod
+    def from_info(cls, info, filename):
+        url = info.get('url')
+        expiry = None
+        if url:
+            # Stream urls from youtube carry their expiry time as a query parameter
+            expire = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get('expire')
+            if expire and expire[0].isdigit():
+                expiry = int(expire[0])
+        duration = info.get('duration')
+        return cls(
+            title=info.get('title', 'Unknown title'),
+            creator=info.get('creator') or info.get('uploader') or 'unknown',
+            duration=int(duration) if duration else None,
+            webpage_url=info.get('webpage_url'),
+            url=url,
+            expiry=expiry,
+            filename=filename,
+            video_id=info.get('id')
+        )
+
+    @property
+    def expired(self):
+        return self.expiry is not None and time.time() >= self.expiry
+
+    @property
+    def duration_text(self):
+        if self._duration_text is None and self.duration is not None:
+            self._duration_text = duration_to_str(self.duration)
+        return self._duration_text
+
+    def __str__(self):
+        # Playlists are rendered over and over, so the text is only built once
+        if self._text is None:
+            duration = f' (duration: {self.duration_text})' if self.duration is not None else ''
+            self._text = f'**{self.title}** from **{self.creator}**{duration}'
+        return self._text
+
+
+class Song(discord.AudioSource):
+    """A playing SongInfo. The audio is decoded and encoded by a voice worker process,
+    this object only hands the worker's Opus packets to the voice client."""
+    def __init__(self, song_info, pool, volume=0.5, start=0):
+        self.song_info = song_info
+        self.track = song_info.track
         self.requester = song_info.requester
         self.channel = song_info.channel
         self.filename = song_info.filename
-        super().__init__(discord.FFmpegPCMAudio(self.filename, before_options='-nostdin', options='-vn'))
+        self._volume = volume
+        # The loudness gain is folded into the worker's volume, so normalizing costs nothing per frame
+        self.session = pool.open(self.filename, volume * self.gain, seek=start)
+        song_info.source = self
+
+    def read(self):
+        return self.session.read()
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.session.cleanup()
+
+    @property
+    def position(self):
+        # Seconds into the song, counted from the frames the voice client has read
+        return self.session.position
+
+    def seek(self, position):
+        # The worker restarts FFmpeg with -ss before -i, so it jumps straight there instead of decoding up to it
+        self.session.seek(position)
+
+    @property
+    def gain(self):
+        return self.track.gain or 1.0
+
+    def apply_gain(self):
+        self.session.volume = self._volume * self.gain
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+        self.apply_gain()
+
+    def __str__(self):
+        return str(self.song_info)
 
 
 class SongInfo:
+    __slots__ = ('track', 'requester', 'channel', 'downloaded', 'local_file', 'source', 'resume_at')
     ytdl_opts = {
         'default_search': 'auto',
         'format': 'bestaudio/best',
@@ -57,15 +322,30 @@ class SongInfo:
         'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
         'noplaylist': True
     }
-    ytdl = youtube_dl.YoutubeDL(ytdl_opts)
+    _ytdl = None
+
+    @classmethod
+    def ytdl(cls):
+        # youtube_dl is slow to import, so it's only loaded by the first music command
+        if cls._ytdl is None:
+            import youtube_dl
+            cls._ytdl = youtube_dl.YoutubeDL(cls.ytdl_opts)
+        return cls._ytdl
 
     def __init__(self, info, requester, channel):
-        self.info = info
+        self.local_file = '_filename' in info
+        filename = info['_filename'] if self.local_file else self.ytdl().prepare_filename(info)
+        self.track = TrackInfo.from_info(info, filename)
+        # The info dict itself isn't kept
         self.requester = requester
         self.channel = channel
-        self.filename = info.get('_filename', self.ytdl.prepare_filename(self.info))
         self.downloaded = asyncio.Event()
-        self.local_file = '_filename' in info
+        self.source = None      # The Song that last played this
+        self.resume_at = 0      # Seconds in to start from, after an interruption or a restart
+
+    @property
+    def filename(self):
+        return self.track.filename
 
     @classmethod
     async def create(cls, query, requester, channel, loop=None):
@@ -94,10 +374,15 @@ class SongInfo:
     @classmethod
     async def from_ytdl(cls, request, requester, channel, loop=None):
         loop = loop or asyncio.get_event_loop()
+        # Everyone asking for the same query at once shares one extraction
+        info = await EXTRACTIONS.run(normalize_query(request), functools.partial(cls.extract, request, loop))
+        return cls(info, requester, channel)
 
+    @classmethod
+    async def extract(cls, request, loop):
         # Get sparse info about our query
-        partial = functools.partial(cls.ytdl.extract_info, request, download=False, process=False)
-        sparse_info = await loop.run_in_executor(None, partial)
+        partial = functools.partial(cls.ytdl().extract_info, request, download=False, process=False)
+        sparse_info = await run_ytdl(loop, partial)
 
         if sparse_info is None:
             raise MusicError(f'Could not retrieve info from input : {request}')
@@ -116,11 +401,15 @@ class SongInfo:
 
         # Process full video info
         url = info_to_process.get('url', info_to_process.get('webpage_url', info_to_process.get('id')))
-        partial = functools.partial(cls.ytdl.extract_info, url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+        return await cls.process(url, loop)
+
+    @classmethod
+    async def process(cls, url, loop):
+        partial = functools.partial(cls.ytdl().extract_info, url, download=False)
+        processed_info = await run_ytdl(loop, partial)
 
         if processed_info is None:
-            raise MusicError(f'Could not retrieve info from input : {request}')
+            raise MusicError(f'Could not retrieve info from input : {url}')
 
         # Select the first search result if any
         if "entries" not in processed_info:
@@ -131,24 +420,110 @@ class SongInfo:
                 try:
                     info = processed_info['entries'].pop(0)
                 except IndexError:
-                    raise MusicError(f'Could not retrieve info from url : {info_to_process["url"]}')
+                    raise MusicError(f'Could not retrieve info from url : {url}')
 
+        return info
+
+    @classmethod
+    async def from_search_result(cls, track, requester, channel, loop=None):
+        # The picked result's page is processed straight away, the search isn't run again
+        return await cls.from_url(track.webpage_url, requester, channel, loop=loop)
+
+    @classmethod
+    async def from_url(cls, url, requester, channel, loop=None):
+        loop = loop or asyncio.get_event_loop()
+        info = await EXTRACTIONS.run(normalize_query(url), functools.partial(cls.process, url, loop))
         return cls(info, requester, channel)
 
+    @classmethod
+    async def restore(cls, saved, requester, channel, loop=None):
+        # Rebuilds a song from its resume point (see resume_point)
+        if saved['file']:
+            song = cls.from_file(saved['file'], requester, channel)
+        else:
+            song = await cls.from_url(saved['url'], requester, channel, loop=loop)
+        song.resume_at = saved['position']
+        return song
+
+    def resume_point(self, position=0):
+        return {
+            'url': self.track.webpage_url,
+            'file': self.filename if self.local_file else None,
+            'requester': self.requester.id,
+            'position': round(position, 2)
+        }
+
+    @classmethod
+    async def search(cls, text, count, loop):
+        """The top count youtube results for text, as TrackInfos without a file.
+        Results are cached for SEARCH_TTL seconds, so a repeated search costs nothing."""
+        key = normalize_query(text)
+        cached = SEARCH_CACHE.get(key)
+        if cached and cached[0] > time.monotonic():
+            SEARCH_CACHE.move_to_end(key)
+            return cached[1]
+
+        results = await EXTRACTIONS.run(('search', key), functools.partial(cls.flat_search, text, count, loop))
+        SEARCH_CACHE[key] = (time.monotonic() + SEARCH_TTL, results)
+        SEARCH_CACHE.move_to_end(key)
+        while len(SEARCH_CACHE) > SEARCH_CACHE_SIZE:
+            SEARCH_CACHE.popitem(last=False)
+        return results
+
+    @classmethod
+    async def flat_search(cls, text, count, loop):
+        # One unprocessed extraction: only the search page is fetched, not every video's page
+        partial = functools.partial(cls.ytdl().extract_info, f'ytsearch{count}:{text}', download=False, process=False)
+        info = await run_ytdl(loop, partial)
+        if info is None:
+            raise MusicError(f'Could not search for : {text}')
+        entries = await run_ytdl(loop, lambda: list(itertools.islice(info.get('entries') or [], count)))
+
+        results = []
+        for entry in entries:
+            if not entry or not entry.get('id'):
+                continue
+            duration = entry.get('duration')
+            results.append(TrackInfo(
+                title=entry.get('title') or entry['id'],
+                creator=entry.get('uploader') or 'youtube',
+                duration=int(duration) if duration else None,
+                webpage_url=entry.get('webpage_url') or f"https://www.youtube.com/watch?v={entry['id']}",
+                video_id=entry['id']
+            ))
+        return results
+
     async def download(self, loop):
-        if not pathlib.Path(self.filename).exists():
-            partial = functools.partial(self.ytdl.extract_info, self.info['webpage_url'], download=True)
-            self.info = await loop.run_in_executor(None, partial)
-        self.downloaded.set()
+        try:
+            if not pathlib.Path(self.filename).exists():
+                # One download per video, so two requests never write the same file at once
+                partial = functools.partial(self.ytdl().extract_info, self.track.webpage_url, download=True)
+                key = self.track.video_id or self.filename
+                info = await DOWNLOADS.run(key, functools.partial(run_ytdl, loop, partial))
+                if info is not None:
+                    self.track = TrackInfo.from_info(info, self.track.filename)
+        finally:
+            self.downloaded.set()   # A failed download still lets the player move on
+        await self.normalize(loop)
+
+    async def normalize(self, loop):
+        # Measures the downloaded file's loudness after the song is ready, so the queue never waits for it;
+        # a song that starts before the measurement is done gets its gain when it arrives
+        if self.local_file or not pathlib.Path(self.filename).exists():
+            return
+        try:
+            loudness = await ANALYSES.run(self.filename, functools.partial(track_loudness, self.filename, loop))
+        except (OSError, ValueError, subprocess.SubprocessError):
+            return  # Played at its own loudness
+        self.track.gain = loudness_gain(loudness)
+        if self.source:
+            self.source.apply_gain()
 
     async def wait_until_downloaded(self):
         await self.downloaded.wait()
 
     def __str__(self):
-        title = f"**{self.info['title']}**"
-        creator = f"**{self.info.get('creator') or self.info['uploader']}**"
-        duration = f" (duration: {duration_to_str(self.info['duration'])})" if 'duration' in self.info else ''
-        return f'{title} from {creator}{duration}'
+        return str(self.track)
 
 
 class Playlist(asyncio.Queue):
@@ -157,17 +532,21 @@ class Playlist(asyncio.Queue):
 
     def clear(self):
         for song in self._queue:
-            try:
-                os.remove(song.filename)
-            except:
-                pass
+            if not song.local_file:
+                release_file(song.filename)
         self._queue.clear()
 
     def get_song(self):
         return self.get_nowait()
 
+    def push_front(self, song):
+        # Puts a song that was taken off back at the front, keeping the hold on its file it already has
+        self._queue.appendleft(song)
+
     def add_song(self, song):
         self.put_nowait(song)
+        if not song.local_file:
+            hold_file(song.filename)
 
     def __str__(self):
         info = 'Current playlist:\n'
@@ -184,10 +563,11 @@ class Playlist(asyncio.Queue):
 
 
 class GuildMusicState:
-    def __init__(self, loop):
+    def __init__(self, loop, pool):
         self.playlist = Playlist(maxsize=50)
         self.voice_client = None
         self.loop = loop
+        self.pool = pool
         self.player_volume = 0.5
         self.skips = set()
         self.min_skips = 5
@@ -216,19 +596,25 @@ class GuildMusicState:
         return self.voice_client and self.voice_client.is_playing()
 
     async def play_next_song(self, song=None, error=None):
+        last = song.source if song else None
+        error = error or (last and last.session.error)
         if error:
             await self.current_song.channel.send(f'An error has occurred while playing {self.current_song}: {error}')
 
-        if song and not song.local_file and song.filename not in [s.filename for s in self.playlist]:
-            os.remove(song.filename)
+        if error and last and last.position > song.resume_at + 1:
+            # Cut off part way (the voice worker died, the connection dropped...):
+            # the song is played again from where it stopped instead of from the start
+            song.resume_at = last.position
+            self.playlist.push_front(song)
+        elif song and not song.local_file:
+            release_file(song.filename)
 
         if self.playlist.empty():
             await self.stop()
         else:
             next_song_info = self.playlist.get_song()
             await next_song_info.wait_until_downloaded()
-            source = Song(next_song_info)
-            source.volume = self.player_volume
+            source = Song(next_song_info, self.pool, self.player_volume, start=next_song_info.resume_at)
             self.voice_client.play(source, after=lambda e: asyncio.run_coroutine_threadsafe(self.play_next_song(next_song_info, e), self.loop).result())
             await next_song_info.channel.send(f'Now playing {next_song_info}')
 
@@ -237,20 +623,59 @@ class Music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.music_states = {}
-
-    def __unload(self):
+        self.exported = False
+        worker = getattr(bot, 'worker', None)
+        self.resume_file = os.path.join(DATA_PATH, f'music_resume{"" if worker is None else f"-{worker}"}.json')
+        self.resume_task = bot.loop.create_task(self.keep_resume_points())
+
+    def export_state(self):
+        # Called by Owner.reload: the playlists and voice clients are handed to the new cog
+        # instead of being stopped, so playback carries on through the reload
+        self.exported = True
+        return {'music_states': self.music_states, 'file_refs': FILE_REFS}
+
+    def import_state(self, state):
+        # The reloaded module starts with no file refs, while the moved songs still hold their files.
+        # After a failed reload the old module is back, and its counts are already these ones
+        file_refs = state.get('file_refs', {})
+        if file_refs is not FILE_REFS:
+            FILE_REFS.update(file_refs)
+        for guild_id, old in state['music_states'].items():
+            new = GuildMusicState(self.bot.loop, old.pool)
+            for song in old.playlist:
+                new.playlist.put_nowait(song)   # Moved over, so the files keep the hold they have
+            new.voice_client = old.voice_client
+            new.player_volume = old.player_volume
+            new.skips = old.skips
+            new.min_skips = old.min_skips
+            old.play_next_song = new.play_next_song
+            # The playing song's `after` callback still points at the old state,
+            # so the old state forwards to the new one when the song ends
+            self.music_states[guild_id] = new
+
+    def cog_unload(self):
+        self.resume_task.cancel()
+        if self.exported:
+            return
         for state in self.music_states.values():
             self.bot.loop.create_task(state.stop())
 
-    def __local_check(self, ctx):
+    @commands.Cog.listener()
+    async def on_guild_data_purge(self, guild_id):
+        # Sent by the cleanup cog once the bot has left a guild: its playlist and file holds go
+        state = self.music_states.pop(guild_id, None)
+        if state:
+            await state.stop()
+
+    def cog_check(self, ctx):
         if not ctx.guild:
             raise commands.NoPrivateMessage('This command cannot be used in a private message.')
         return True
 
-    async def __before_invoke(self, ctx):
+    async def cog_before_invoke(self, ctx):
         ctx.music_state = self.get_music_state(ctx.guild.id)
 
-    async def __error(self, ctx, error):
+    async def cog_command_error(self, ctx, error):
         if not isinstance(error, commands.UserInputError):
             raise error
 
@@ -259,15 +684,76 @@ class Music(commands.Cog):
         except discord.Forbidden:
             pass # /shrug
 
+    async def keep_resume_points(self):
+        # Restores the playback saved before a restart, then keeps saving where each guild is
+        await self.bot.wait_until_ready()
+        await self.restore_playback()
+        while True:
+            await asyncio.sleep(RESUME_INTERVAL)
+            self.save_resume_points()
+
+    def save_resume_points(self):
+        saved = {}
+        for guild_id, state in self.music_states.items():
+            current = state.current_song if state.is_playing() else None
+            if not isinstance(current, Song):
+                continue
+            songs = [current.song_info.resume_point(current.position)]
+            songs += [song.resume_point(song.resume_at) for song in state.playlist]
+            saved[str(guild_id)] = {
+                'voice_channel': state.voice_client.channel.id,
+                'text_channel': current.channel.id,
+                'songs': songs
+            }
+        os.makedirs(DATA_PATH, exist_ok=True)
+        with open(self.resume_file + '.tmp', 'w') as f:
+            json.dump(saved, f)
+        os.replace(self.resume_file + '.tmp', self.resume_file)
+
+    async def restore_playback(self):
+        # Rejoins the voice channels that were playing when the bot stopped and carries on
+        # from the saved positions; guilds that are already playing (e.g. after a reload) are left alone
+        try:
+            with open(self.resume_file, 'r') as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        for guild_id, entry in saved.items():
+            guild = self.bot.get_guild(int(guild_id))
+            if guild is None or guild.voice_client or int(guild_id) in self.music_states:
+                continue
+            voice_channel = guild.get_channel(entry['voice_channel'])
+            text_channel = guild.get_channel(entry['text_channel'])
+            if voice_channel is None or text_channel is None:
+                continue
+
+            state = self.get_music_state(guild.id)
+            try:
+                state.voice_client = await voice_channel.connect()
+                for item in entry['songs']:
+                    requester = guild.get_member(item['requester']) or guild.me
+                    song = await SongInfo.restore(item, requester, text_channel, loop=self.bot.loop)
+                    self.bot.loop.create_task(song.download(self.bot.loop))
+                    state.playlist.add_song(song)
+                await state.play_next_song()
+            except (discord.DiscordException, MusicError, asyncio.TimeoutError) as e:
+                print(f'Could not resume playback in {guild}: {e}')
+
     def get_music_state(self, guild_id):
-        return self.music_states.setdefault(guild_id, GuildMusicState(self.bot.loop))
+        state = self.music_states.get(guild_id)
+        if state is None:
+            state = self.music_states[guild_id] = GuildMusicState(self.bot.loop, get_pool())
+            state.min_skips = self.bot.settings.get(guild_id, 'music_min_skips')
+        return state
 
     @commands.command()
     async def status(self, ctx):
         """Displays the currently played song."""
         if ctx.music_state.is_playing():
             song = ctx.music_state.current_song
-            await ctx.send(f'Playing {song}. Volume at {song.volume * 100}% in {ctx.voice_client.channel.mention}')
+            position = f' at {format_position(song.position)}' if isinstance(song, Song) else ''
+            await ctx.send(f'Playing {song}{position}. Volume at {song.volume * 100}% in {ctx.voice_client.channel.mention}')
         else:
             await ctx.send('Not playing.')
 
@@ -303,23 +789,84 @@ class Music(commands.Cog):
 
         # Create the SongInfo
         song = await SongInfo.create(request, ctx.author, ctx.channel, loop=ctx.bot.loop)
+        await self.enqueue(ctx, song)
 
+        await ctx.message.remove_reaction('\N{HOURGLASS}', ctx.me)
+        await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
+
+    async def enqueue(self, ctx, song):
         # Connect to the voice channel if needed
         if ctx.voice_client is None or not ctx.voice_client.is_connected():
             await ctx.invoke(self.join)
+        elif ctx.music_state.voice_client is None:
+            ctx.music_state.voice_client = ctx.voice_client
+            # Connected by another cog (yt, stream, the soundboard), so the playlist plays through it
 
-            # Schedule the song's download
+        # Schedule the song's download
         ctx.bot.loop.create_task(song.download(ctx.bot.loop))
-        await ctx.send(f'Queued {song} in position **#1**')
+        ctx.music_state.playlist.add_song(song)
+        await ctx.send(f'Queued {song} in position **#{ctx.music_state.playlist.qsize()}**')
 
-        await ctx.message.remove_reaction('\N{HOURGLASS}', ctx.me)
-        await ctx.message.add_reaction('\N{WHITE HEAVY CHECK MARK}')
+        if not ctx.music_state.is_playing():
+            await ctx.music_state.play_next_song()
 
     @play.error
     async def play_error(self, ctx, error):
         await ctx.message.remove_reaction('\N{HOURGLASS}', ctx.me)
         await ctx.message.add_reaction('\N{CROSS MARK}')
 
+    @commands.command()
+    async def search(self, ctx, *, text: str):
+        """Searches youtube and lets you pick the song to play,
+        by reacting with its number or sending the number.
+        """
+        results = await SongInfo.search(text, SEARCH_RESULTS, ctx.bot.loop)
+        if not results:
+            raise MusicError(f'No results for : {text}')
+
+        lines = [f'{NUMBER_EMOJIS[i]} {track}' for i, track in enumerate(results)]
+        msg = await ctx.send('Pick a song by reacting or sending its number:\n' + '\n'.join(lines))
+        adding = self.bot.loop.create_task(self.add_number_reactions(msg, len(results)))
+        # Added in the background, so a pick can be made before every reaction is there
+
+        pick = await self.wait_for_pick(ctx, msg, len(results))
+        adding.cancel()
+        if pick is None:
+            await msg.edit(content=msg.content + '\nSearch timed out.')
+            return
+
+        song = await SongInfo.from_search_result(results[pick], ctx.author, ctx.channel, loop=ctx.bot.loop)
+        await self.enqueue(ctx, song)
+
+    async def add_number_reactions(self, msg, count):
+        for emoji in NUMBER_EMOJIS[:count]:
+            await msg.add_reaction(emoji)
+
+    async def wait_for_pick(self, ctx, msg, count):
+        # Returns the index of the picked result, or None if the user didn't pick in time
+        def reaction_check(reaction, user):
+            return (user == ctx.author and reaction.message.id == msg.id
+                    and str(reaction.emoji) in NUMBER_EMOJIS[:count])
+
+        def message_check(message):
+            return (message.author == ctx.author and message.channel == ctx.channel
+                    and message.content.strip().isdigit() and 1 <= int(message.content) <= count)
+
+        waiters = [
+            asyncio.ensure_future(self.bot.wait_for('reaction_add', check=reaction_check)),
+            asyncio.ensure_future(self.bot.wait_for('message', check=message_check))
+        ]
+        done, pending = await asyncio.wait(waiters, timeout=SEARCH_TIMEOUT, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+        if not done:
+            return None
+
+        result = done.pop().result()
+        if isinstance(result, tuple):
+            return NUMBER_EMOJIS.index(str(result[0].emoji))
+        return int(result.content) - 1
+
     @commands.command()
     @commands.has_permissions(manage_guild=True)
     async def pause(self, ctx):
@@ -340,9 +887,30 @@ class Music(commands.Cog):
         """Stops the player, clears the playlist and leaves the voice channel."""
         await ctx.music_state.stop()
 
+    @commands.command()
+    async def seek(self, ctx, position: str):
+        """Jumps to a time in the current song, e.g. `seek 1:30`, `seek +15` or `seek -10`."""
+        voice = ctx.voice_client
+        song = voice.source if voice and (voice.is_playing() or voice.is_paused()) else None
+        session = getattr(song, 'session', None)
+        if session is None:
+            raise MusicError('Not playing anything to seek in.')
+        # Read from the voice client, so songs from the voice cog's yt and stream seek the same way:
+        # their worker re-opens the file or stream at the offset
+
+        seconds = parse_position(position, session.position)
+        track = getattr(song, 'track', None)
+        duration = track.duration if track else getattr(song, 'data', {}).get('duration')
+        if seconds < 0 or (duration and seconds >= duration):
+            raise MusicError(f'{position} is outside of the song.')
+        session.seek(seconds)
+        await ctx.send(f'Jumped to {format_position(seconds)} in {song}')
+
     @commands.command()
     async def volume(self, ctx, volume: int = None):
         """Sets the volume of the player, scales from 0 to 100."""
+        if volume is None:
+            return await ctx.send(f'Volume at {ctx.music_state.volume * 100:.0f}%')
         if volume < 0 or volume > 100:
             raise MusicError('The volume level has to be between 0 and 100.')
         ctx.music_state.volume = volume / 100
@@ -378,4 +946,6 @@ class Music(commands.Cog):
         """Sets the minimum number of votes to skip a song.
         Requires the `Manage Guild` permission.
         """
+        await wait_until_open(self.bot)  # A change made before the settings load would be lost
+        await self.bot.settings.update(ctx.guild.id, music_min_skips=number)
         ctx.music_state.min_skips = number
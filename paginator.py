@@ -0,0 +1,74 @@
+'''
+paginator.py holds the helpers the cogs use to split long outputs
+over several embeds and let a user flick between them with reactions.
+Discord only allows 25 fields (and 6000 characters) per embed,
+so anything that grows with the number of commands or users must be paged.
+'''
+
+import asyncio
+import discord
+
+FIELD_LIMIT = 25        # Hard Discord limit of fields in one embed
+FIELD_VALUE_LIMIT = 1024
+PREVIOUS_PAGE = '\N{BLACK LEFT-POINTING TRIANGLE}'
+NEXT_PAGE = '\N{BLACK RIGHT-POINTING TRIANGLE}'
+
+def truncate(text, limit=FIELD_VALUE_LIMIT):
+    '''Shortens a field value so Discord doesn't reject the embed'''
+    text = str(text) if text else '-'
+    return text if len(text) <= limit else text[:limit - 3] + '...'
+
+def build_pages(title, fields, per_page=10, colour=None, inline=False):
+    '''
+    Splits a list of (name, value) fields into a list of embeds,
+    each holding at most per_page fields, with a "Page x/y" footer
+    '''
+
+    per_page = min(per_page, FIELD_LIMIT)
+    chunks = [fields[i:i + per_page] for i in range(0, len(fields), per_page)] or [[]]
+    colour = colour if colour is not None else discord.Colour.blue()
+
+    pages = []
+    for number, chunk in enumerate(chunks, start=1):
+        embed = discord.Embed(title=title, colour=colour)
+        for name, value in chunk:
+            embed.add_field(name=truncate(name, 256), value=truncate(value), inline=inline)
+        embed.set_footer(text=f'Page {number}/{len(chunks)}')
+        pages.append(embed)
+    return pages
+
+async def paginate(bot, destination, user, pages, timeout=60):
+    '''
+    Sends the first page to destination and lets user change page with reactions.
+    Both adding and removing a reaction turn the page, since the bot
+    can't remove other users' reactions in a private message.
+    '''
+
+    index = 0
+    msg = await destination.send(embed=pages[index])
+    if len(pages) == 1:
+        return msg
+
+    for emoji in (PREVIOUS_PAGE, NEXT_PAGE):
+        await msg.add_reaction(emoji)
+
+    def check(reaction, reactor):
+        return (reactor == user and reaction.message.id == msg.id
+                and str(reaction.emoji) in (PREVIOUS_PAGE, NEXT_PAGE))
+
+    while True:
+        waiters = [
+            asyncio.ensure_future(bot.wait_for('reaction_add', check=check)),
+            asyncio.ensure_future(bot.wait_for('reaction_remove', check=check))
+        ]
+        done, pending = await asyncio.wait(
+            waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in pending:
+            waiter.cancel()
+        if not done:
+            return msg  # Stops listening once the user has gone quiet
+
+        reaction, _ = done.pop().result()
+        step = -1 if str(reaction.emoji) == PREVIOUS_PAGE else 1
+        index = (index + step) % len(pages)
+        await msg.edit(embed=pages[index])
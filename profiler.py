@@ -0,0 +1,151 @@
+'''
+profiler.py is an opt-in profiler for the event loop.
+While it runs, a watchdog thread samples the stack of the event loop's thread
+every few milliseconds. The samples are kept as folded stacks
+("frame;frame;frame count", the format flamegraph.pl and speedscope read),
+and any time the loop doesn't tick for longer than the threshold is counted
+as blocked and put down to the cog and function on the stack.
+It also turns on asyncio's own slow callback warnings.
+'''
+
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+FILE_PATH = os.path.dirname(os.path.abspath(__file__))
+INTERVAL = 0.005    # Seconds between stack samples
+THRESHOLD = 0.1     # The loop counts as blocked after this many seconds without a tick
+MAX_STACKS = 20000  # Distinct folded stacks kept, so a long session can't grow without bound
+SLOW_EVENTS = 50    # Recent blocking events kept with their stack
+
+def frame_name(frame):
+    '''Names a frame as file:function, with the file relative to the bot'''
+    path = frame.f_code.co_filename
+    if path.startswith(FILE_PATH):
+        path = os.path.relpath(path, FILE_PATH)
+    else:
+        path = os.path.basename(path)
+    return f'{path}:{frame.f_code.co_name}'
+
+def fold(frame):
+    '''Turns a frame and its callers into one folded stack, outermost first'''
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+def attribute(frame):
+    '''
+    Finds the innermost frame of the bot's own code (a cog, music.py, ...)
+    and names it as cog.function, e.g. "owner.prefix", or "other" if there isn't one
+    '''
+    while frame is not None:
+        path = frame.f_code.co_filename
+        if path.startswith(FILE_PATH) and not path.endswith('profiler.py'):
+            module = os.path.splitext(os.path.basename(path))[0]
+            return f'{module}.{frame.f_code.co_name}'
+        frame = frame.f_back
+    return 'other'
+
+class LoopProfiler:
+    '''Samples one event loop from a watchdog thread'''
+
+    def __init__(self, loop, interval=INTERVAL, threshold=THRESHOLD):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.running = False
+        self.generation = 0     # Bumped by start and stop, so an old tick chain or watchdog ends itself
+        self.loop_thread = None
+        self.last_tick = 0.0
+        self.reset()
+
+    def reset(self):
+        self.stacks = collections.Counter()     # folded stack -> samples
+        self.blocked = collections.Counter()    # cog.function -> seconds the loop was blocked
+        self.slow_events = collections.deque(maxlen=SLOW_EVENTS)
+        self.samples = 0
+        self.started = time.monotonic()
+
+    def start(self, threshold=None):
+        '''Starts sampling; safe to call from any thread'''
+        if self.running:
+            return
+        self.threshold = threshold or self.threshold
+        self.running = True
+        self.generation += 1
+        self.reset()
+        self.loop.call_soon_threadsafe(self.tick, self.generation)
+        self.loop.call_soon_threadsafe(self.enable_debug)
+        threading.Thread(target=self.watch, args=(self.generation,), name='loop-profiler', daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.generation += 1
+        self.loop.call_soon_threadsafe(self.loop.set_debug, False)
+
+    def enable_debug(self):
+        '''Lets asyncio log every callback slower than the threshold'''
+        self.loop.set_debug(True)
+        self.loop.slow_callback_duration = self.threshold
+        logging.getLogger('asyncio').setLevel(logging.WARNING)
+
+    def tick(self, generation):
+        '''Runs on the loop; proves to the watchdog that the loop isn't blocked'''
+        if generation != self.generation:
+            return      # Stopped, or restarted with a tick chain of its own
+        self.loop_thread = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.loop.call_later(self.interval, self.tick, generation)
+
+    def watch(self, generation):
+        '''The watchdog thread: samples the loop's stack and measures how long it stays blocked'''
+        block_start = None
+        block_place = block_stack = None
+        while generation == self.generation:
+            time.sleep(self.interval)
+            if generation != self.generation:
+                break   # A stop, or a stop and start, happened while this thread slept
+            if self.loop_thread is None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+
+            stack = fold(frame)
+            if stack in self.stacks or len(self.stacks) < MAX_STACKS:
+                self.stacks[stack] += 1
+            self.samples += 1
+
+            now = time.monotonic()
+            if now - self.last_tick > self.threshold + self.interval:
+                place = attribute(frame)
+                self.blocked[place] += self.interval
+                if block_start is None:
+                    block_start, block_place, block_stack = self.last_tick, place, stack
+            elif block_start is not None:
+                self.slow_events.append((now - block_start, block_place, block_stack))
+                block_start = None
+
+    def dump(self, path):
+        '''Writes the folded stacks to path, ready for flamegraph.pl or speedscope'''
+        with open(path, 'w') as _f:
+            for stack, count in self.stacks.most_common():
+                _f.write(f'{stack} {count}\n')
+        return path
+
+    def report(self, top=10):
+        '''A short text summary of where the loop spent its blocked time'''
+        lines = [f'{self.samples} samples over {time.monotonic() - self.started:.0f}s, '
+                 f'threshold {self.threshold * 1000:.0f}ms']
+        for place, seconds in self.blocked.most_common(top):
+            lines.append(f'    {place}: blocked {seconds * 1000:.0f}ms')
+        if self.slow_events:
+            lines.append('Slowest recent blocks:')
+            for duration, place, _ in sorted(self.slow_events, reverse=True)[:5]:
+                lines.append(f'    {duration * 1000:.0f}ms in {place}')
+        return '\n'.join(lines)
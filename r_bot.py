@@ -27,96 +27,289 @@ Band A.1 = an example of: Server-side extensions...
 # https://discordapp.com/oauth2/authorize?bot_id=519932173969522698&scope=bot&permissions=8
 # Use CMD instead of IDLE, E.g. echo command won't work properly with idle
 
-from itertools import cycle
+import argparse
+import contextlib
 import json
 import os
+import sys
+import time
 import asyncio
-import asyncpg
 import discord
 from discord.ext import commands
+from antispam import SpamFilter
+from storage import (PostgresSettingsRepository, SQLiteSettingsRepository, load_config, open_levels)
+from settings import GuildSettings
+from profiler import LoopProfiler
 # Every python script that involves the bot's events/commands
 # will call parameterised web server API's - the discord modules (Band A.2)
 
 # ------------------------- Constants -------------------------
 
+START = time.perf_counter()   # Cold start timings are measured from here
+
+PARSER = argparse.ArgumentParser(description='Runs R-bot, or one worker of it under launcher.py')
+PARSER.add_argument('--shard-count', type=int, help='total number of shards across all workers')
+PARSER.add_argument('--shard-ids', help='range of shards this process owns, e.g. 0-3')
+PARSER.add_argument('--worker', type=int, help='worker number given by launcher.py')
+PARSER.add_argument('--profile', action='store_true', help='profile the event loop from startup')
+ARGS = PARSER.parse_args() if __name__ == '__main__' else PARSER.parse_args([])
+# Without arguments the bot auto-shards inside this one process
+# Voice worker processes re-import this file on Windows, and mustn't read their own arguments
+
 FILE_PATH = os.path.dirname(__file__)
 # Sets current directory to R-bot's directory
 TOKEN_FILE = os.path.join(FILE_PATH + "\\data\\token.txt")
 TOKEN = open(TOKEN_FILE, 'r').read()
 # Reads the token found in the text file
 
-def get_prefix(rbot, message):
+CONFIG = load_config()   # data/config.json over the defaults in storage.py
+
+PRESENCE_INTERVAL = 60  # Seconds between presence checks; Discord allows 5 updates a minute per shard
+HEALTH_MAX_AGE = 60     # Seconds after which another worker's health report is too old to count
+DB_RETRIES = 5          # Attempts at opening the database, 1, 2, 4, 8 then 16 seconds apart
+
+async def get_prefix(rbot, message):
     '''
     Changes the command prefix depending on what guild the user typed the command.
-    I use a Band A technique here, where I parse a json file, storing prefixes,
-    to service my bot which effectively runs on a client-server model
+    The prefixes are per-guild settings (see settings.py), read from memory
+    instead of parsing a json file on every message
     '''
 
     if not message.guild:
         return commands.when_mentioned_or('r-')(rbot, message)
 
-    # These operating system algorithms aren't in Band A,
-    # but they are an example of complex code
-    file_path = os.path.dirname(__file__)
-    prefix_file = os.path.join(file_path + "\\data\\prefixes.json")
-    with open(prefix_file, 'r') as _f:
-        prefixes = json.load(_f)
-        # The prefixes are loaded into the json file and parsed to the bot (Band A.2)
-
-    if str(message.guild.id) not in prefixes:
+    if not rbot.db_ready.is_set():
+        # Custom prefixes are only known once the settings are loaded,
+        # until then the default prefix works instead of making every message wait
         return commands.when_mentioned_or('r-')(rbot, message)
-        # If the current guild doesn't have a custom prefix, the default prefix will be 'r-'
-
-    prefix = prefixes[str(message.guild.id)]
+    prefix = rbot.settings.get(message.guild.id, 'prefix')
+    # Guilds without a custom prefix get the default prefix 'r-'
     return commands.when_mentioned_or(prefix)(rbot, message)
 
+def parse_shard_ids(text):
+    '''Turns "0-3" into [0, 1, 2, 3]'''
+    first, _, last = text.partition('-')
+    return list(range(int(first), int(last or first) + 1))
+
 DESCRIPTION = "A bot made for helping out human users"
-BOT = commands.Bot(command_prefix=get_prefix, description=DESCRIPTION)
+INTENTS = discord.Intents.default()
+INTENTS.members = True
+# Without the members intent on_member_join never fires (so raids go unseen) and the member cache stays
+# nearly empty; it's a privileged intent, so it must also be enabled for the bot in the developer portal
+BOT = commands.AutoShardedBot(
+    command_prefix=get_prefix,
+    description=DESCRIPTION,
+    intents=INTENTS,
+    shard_count=ARGS.shard_count,
+    shard_ids=parse_shard_ids(ARGS.shard_ids) if ARGS.shard_ids else None
+)
 # Initiates bot with keyword from json file and the bot's description
+# Every process has its own bot, database pool and caches, so workers share nothing
 
 BOT.remove_command('help')
 # Removes default help command so I can make my own
 
+BOT.spam_filter = SpamFilter()
+BOT.pg_con = None
+BOT.levels = None   # The level store (see storage.py), opened by create_db_pool
+BOT.settings = GuildSettings()  # Per-guild settings (see settings.py), loaded by create_db_pool
+BOT.db_ready = asyncio.Event()
+BOT.db_failed = False   # Set when create_db_pool gave up, so the process exits with an error
+# Cogs wait on db_ready instead of the bot waiting for the database before connecting
+BOT.startup_timings = {}    # Seconds each startup phase took
+BOT.worker = ARGS.worker    # Worker number under launcher.py, None when run on its own
+BOT.presence_text = None   # The status last sent, see keep_presence
+BOT.profiler = LoopProfiler(BOT.loop)
+if ARGS.profile:
+    BOT.profiler.start()    # Otherwise started with "r-profile start"
+# Shared by every on_message listener, so spam is caught before any database work
+
 # ------------------------- Background tasks -------------------------
 
-async def change_status():
-    '''aynchronous function without threading'''
+def playing_count():
+    '''How many of this process' voice clients are playing'''
+    return sum(1 for voice in BOT.voice_clients if voice.is_playing())
+
+def short_count(number):
+    '''Turns 12345 into "12.3k", so the presence doesn't change with every guild joined'''
+    if number < 1000:
+        return str(number)
+    return f'{number / 1000:.1f}k'
+
+def bot_totals():
+    '''
+    Returns (guilds, songs playing) across the whole bot.
+    Under launcher.py the other workers' numbers come from their health reports,
+    so every worker shows the same totals without talking to each other
+    '''
+    guilds, playing = len(BOT.guilds), playing_count()
+    if ARGS.worker is None:
+        return guilds, playing
+    health_dir = os.path.join(FILE_PATH, 'data', 'health')
+    now = time.time()
+    for name in os.listdir(health_dir) if os.path.isdir(health_dir) else []:
+        if name == f'worker-{ARGS.worker}.json' or not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(health_dir, name), 'r') as _f:
+                health = json.load(_f)
+        except (OSError, ValueError):
+            continue    # Being replaced, or left behind by a worker that is gone
+        if now - health['time'] < HEALTH_MAX_AGE:
+            guilds += health['guilds']
+            playing += health.get('playing', 0)
+    return guilds, playing
+
+def presence_text():
+    '''The status shown under the bot's name'''
+    guilds, playing = bot_totals()
+    text = f'r-help | {short_count(guilds)} servers'
+    if playing:
+        text += f' | {short_count(playing)} playing'
+    return text
+
+async def keep_presence():
+    '''
+    Updates the bot's status, only when the text shown would change and at most once a PRESENCE_INTERVAL.
+    A presence is sent on each shard's own connection, so every process updates its own shards;
+    they all compute the same text, and none sends anything while it stays the same
+    '''
     await BOT.wait_until_ready()    # Will not run until ready() is True
-    status = ['Eating cake', 'Debugging errors', 'Testing']
-    msgs = cycle(status)    # Cycles through the list of pre-given messages
+    while not BOT.is_closed():
+        text = presence_text()
+        if text != BOT.presence_text:
+            await BOT.change_presence(activity=discord.Game(text))
+            BOT.presence_text = text
+        await asyncio.sleep(PRESENCE_INTERVAL)
+        # asyncio.sleep instead of time.sleep, which would pause the entire program
+
+async def restore_presence(shard_id):
+    '''A shard that had to identify again lost its presence, so only that shard is sent it again'''
+    if BOT.presence_text:
+        await BOT.change_presence(activity=discord.Game(BOT.presence_text), shard_id=shard_id)
+
+async def report_health():
+    '''
+    Writes this worker's health to data/health/worker-<n>.json every 15 seconds,
+    where launcher.py collects it. Only runs when started by the launcher.
+    Reports start before the bot is ready, marked "connecting", so a worker
+    still identifying many shards isn't taken for a hung one
+    '''
+    health_dir = os.path.join(FILE_PATH, 'data', 'health')
+    os.makedirs(health_dir, exist_ok=True)
+    health_file = os.path.join(health_dir, f'worker-{ARGS.worker}.json')
 
     while not BOT.is_closed():
-        current_status = next(msgs)
-        await BOT.change_presence(activity=discord.Game(current_status))
-        # shows what activity the bot is doing (in reality, any string I choose)
-        await asyncio.sleep(5)
-        # Cycles this specific function every 3 seconds instead of using -
-        # - time.sleep(3), which pauses entire program for 3 seconds
+        health = {
+            'worker': ARGS.worker,
+            'pid': os.getpid(),
+            'time': time.time(),
+            'status': 'ready' if BOT.is_ready() else 'connecting',
+            'shards': {shard_id: latency for shard_id, latency in BOT.latencies},
+            'guilds': len(BOT.guilds),
+            'voice_clients': len(BOT.voice_clients),
+            'playing': playing_count()
+        }
+        with open(health_file + '.tmp', 'w') as _f:
+            json.dump(health, _f)
+        os.replace(health_file + '.tmp', health_file)
+        # Written then renamed, so the launcher never reads half a file
+        await asyncio.sleep(15)
+
+def record_phase(name, since):
+    '''Records how long a startup phase took'''
+    BOT.startup_timings[name] = round(time.perf_counter() - since, 3)
 
 # This procedure creates the database into asyncpg (Band C.1)
-async def create_db_pool():
-    '''Connects to the database using asyncpg.'''
-    BOT.pg_con = await asyncpg.create_pool(
-        database='levelDB',
-        user='postgres',
-        password='password')
-    
+async def open_database():
+    '''
+    Opens the level store chosen in the config while the bot connects to Discord:
+    the levelDB Postgres database through asyncpg, or an embedded SQLite file.
+    The guild settings are kept in the same store and loaded into memory here
+    '''
+    phase = time.perf_counter()
+    BOT.pg_con, BOT.levels = await open_levels(CONFIG)
+    if BOT.pg_con is None:
+        BOT.settings.repository = SQLiteSettingsRepository(BOT.levels)
+    else:
+        BOT.settings.repository = PostgresSettingsRepository(BOT.pg_con)
+    record_phase('db_pool', phase)
 
-# ------------------------- Main loop -------------------------
+    phase = time.perf_counter()
+    await BOT.settings.load()
+    migrated = await BOT.settings.migrate_prefixes(os.path.join(FILE_PATH, 'data', 'prefixes.json'))
+    if migrated:
+        print(f"{time.strftime('%X')}: moved {migrated} prefixes from prefixes.json into the settings")
+    record_phase('settings', phase)
 
-# Loads each cog in the "cogs" directory (Band A.4)
-for cog in os.listdir('.\\cogs'):
-    if cog.endswith('.py'):
-        # Looks for the python cogs in the current directory
+async def create_db_pool():
+    '''
+    Opens the database, retrying with a growing delay.
+    If it still can't be opened the bot shuts down, instead of running on
+    with every command waiting for a database that will never be there
+    '''
+    for attempt in range(DB_RETRIES):
         try:
-            cog = f"cogs.{cog.replace('.py', '')}"
-            BOT.load_extension(cog)
-            print(f'{cog} loaded')
-            # Loads each file as cog.{filename} and prints them
+            await open_database()
         except Exception as _e:
-            print(f'{cog} cannot be loaded')
-            raise _e
+            print(f"{time.strftime('%X')}: the database could not be opened ({attempt + 1}/{DB_RETRIES}): {_e!r}")
+            if BOT.levels:
+                with contextlib.suppress(Exception):
+                    await BOT.levels.close()
+            BOT.pg_con = BOT.levels = None
+            if attempt + 1 < DB_RETRIES:
+                await asyncio.sleep(2 ** attempt)
+        else:
+            BOT.db_ready.set()
+            return
+    print(f"{time.strftime('%X')}: giving up on the database, shutting down")
+    BOT.db_failed = True
+    await BOT.close()
+
+async def record_startup():
+    '''
+    Waits until the bot is ready and appends the startup timings to data/startup.jsonl,
+    so the cold start time of each deploy can be compared
+    '''
+    await BOT.wait_until_ready()
+    record_phase('ready', START)
+    await BOT.db_ready.wait()
+    record_phase('total', START)
+    print(f"{time.strftime('%X')}: startup timings {BOT.startup_timings}")
+
+    with open(os.path.join(FILE_PATH, 'data', 'startup.jsonl'), 'a') as _f:
+        _f.write(json.dumps({'time': time.time(), **BOT.startup_timings}) + '\n')
+
+# ------------------------- Main loop -------------------------
+
+if __name__ == '__main__':
+    # Guarded so the voice worker processes (voice_worker.py) can import this file without starting a bot
+    # Loads each cog in the "cogs" directory (Band A.4)
+    phase = time.perf_counter()
+    for cog in os.listdir('.\\cogs'):
+        if cog.endswith('.py'):
+            # Looks for the python cogs in the current directory
+            try:
+                cog = f"cogs.{cog.replace('.py', '')}"
+                BOT.load_extension(cog)
+                print(f'{cog} loaded')
+                # Loads each file as cog.{filename} and prints them
+            except Exception as _e:
+                print(f'{cog} cannot be loaded')
+                raise _e
+
+    BOT.load_extension('music')
+    print('music loaded')
+    # The playlist player lives outside the cogs folder, so it's loaded by its own name
+
+    record_phase('cogs', phase)
 
-BOT.loop.run_until_complete(create_db_pool())
-BOT.loop.create_task(change_status())   # Starts the status' cycle
-BOT.run(TOKEN)  # Runs the bot using it's unique token
+    BOT.loop.create_task(create_db_pool())  # Warms up alongside the gateway connection
+    BOT.loop.create_task(record_startup())
+    BOT.loop.create_task(keep_presence())   # Keeps the status up to date
+    BOT.add_listener(restore_presence, 'on_shard_ready')
+    if ARGS.worker is not None:
+        BOT.loop.create_task(report_health())
+    BOT.run(TOKEN)  # Runs the bot using it's unique token
+    if BOT.db_failed:
+        sys.exit('R-bot stopped: the database could not be opened')
@@ -0,0 +1,124 @@
+'''
+settings.py keeps the per-guild settings (prefix, xp policy, anti-spam and raid
+options, music skip votes) in one place.
+Every setting is declared once below with its type and default; a guild only
+stores the settings it changed, in the guild_settings table of whichever level
+backend the bot uses (see storage.py).
+Reads never leave memory: each guild has a read-only snapshot that a write
+replaces with a new one (copy-on-write), so a reader holding a snapshot
+always sees a consistent set of values.
+'''
+
+import json
+import os
+from types import MappingProxyType
+
+class Setting:
+    '''A typed setting with a default; convert turns user input into the type'''
+    __slots__ = ('name', 'type', 'default', 'description')
+
+    def __init__(self, name, type, default, description):
+        self.name = name
+        self.type = type
+        self.default = default
+        self.description = description
+
+    def convert(self, value):
+        '''Checks (and where it can, converts) a value, raising ValueError if it doesn't fit'''
+        if self.type is bool and isinstance(value, str):
+            if value.lower() in ('on', 'yes', 'true', '1'):
+                return True
+            if value.lower() in ('off', 'no', 'false', '0'):
+                return False
+            raise ValueError(f'{self.name} must be on or off')
+        if self.type is tuple:
+            return tuple(int(v) for v in value)
+        return self.type(value)
+
+SETTINGS = {setting.name: setting for setting in (
+    Setting('prefix', str, 'r-', 'Command prefix'),
+    Setting('xp_cooldown', int, 30, 'Seconds before a member can gain xp again'),
+    Setting('xp_min_length', int, 3, 'Shorter messages give no xp'),
+    Setting('xp_min', int, 1, 'Least xp given for a message'),
+    Setting('xp_max', int, 2, 'Most xp given for a message'),
+    Setting('xp_allowed', tuple, (), 'If not empty, only these channel ids give xp'),
+    Setting('xp_denied', tuple, (), 'These channel ids never give xp'),
+    Setting('spam_mute', bool, True, 'Mute members who keep spamming'),
+    Setting('spam_strikes', int, 3, 'Spam strikes before a mute'),
+    Setting('spam_mute_time', int, 600, 'Seconds a spam mute lasts'),
+    Setting('raid_lockdown', bool, True, 'Lock the guild down when a raid is detected'),
+    Setting('music_min_skips', int, 5, 'Votes needed to skip a song'),
+)}
+
+DEFAULTS = MappingProxyType({name: setting.default for name, setting in SETTINGS.items()})
+
+class GuildSettings:
+    '''
+    The settings of every guild, cached in memory.
+    repository is a Postgres/SQLiteSettingsRepository (storage.py), or None to keep
+    the settings in memory only (e.g. the load test).
+    '''
+
+    def __init__(self, repository=None):
+        self.repository = repository
+        self.snapshots = {}  # guild id -> read-only mapping of every setting
+
+    async def load(self):
+        '''Fills the cache from the repository, once at startup'''
+        changed = {}
+        for guild_id, key, value in await self.repository.load_all():
+            if key in SETTINGS:     # Settings that were since removed are ignored
+                changed.setdefault(guild_id, {})[key] = SETTINGS[key].convert(json.loads(value))
+        self.snapshots = {guild_id: MappingProxyType({**DEFAULTS, **values})
+                          for guild_id, values in changed.items()}
+
+    def snapshot(self, guild_id):
+        '''Returns every setting of the guild; the same object until one of them changes'''
+        return self.snapshots.get(guild_id, DEFAULTS)
+
+    def get(self, guild_id, key):
+        return self.snapshot(guild_id)[key]
+
+    async def update(self, guild_id, **values):
+        '''Changes one or more settings of the guild, then swaps in a new snapshot'''
+        values = {key: SETTINGS[key].convert(value) for key, value in values.items()}
+        if self.repository:
+            for key, value in values.items():
+                if value == SETTINGS[key].default:
+                    await self.repository.delete(guild_id, key)
+                else:
+                    await self.repository.save(guild_id, key, json.dumps(value))
+        self.snapshots[guild_id] = MappingProxyType({**self.snapshot(guild_id), **values})
+        return self.snapshots[guild_id]
+
+    async def reset(self, guild_id, *keys):
+        '''Puts the given settings (all of them if none are given) back to their defaults'''
+        keys = keys or tuple(SETTINGS)
+        return await self.update(guild_id, **{key: SETTINGS[key].default for key in keys})
+
+    async def guild_ids(self):
+        '''The guilds that changed any setting'''
+        if self.repository:
+            return await self.repository.guild_ids()
+        return set(self.snapshots)
+
+    async def purge(self, guild_id):
+        '''Forgets every setting of a guild the bot has left; returns the rows deleted'''
+        self.snapshots.pop(guild_id, None)
+        if self.repository:
+            return await self.repository.delete_guild(guild_id)
+        return 0
+
+    async def migrate_prefixes(self, path):
+        '''
+        Moves the prefixes of the old data/prefixes.json into the settings, the first
+        time the bot starts with a settings store; the file is then renamed so it is only done once
+        '''
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'r') as _f:
+            prefixes = json.load(_f)
+        for guild_id, prefix in prefixes.items():
+            await self.update(int(guild_id), prefix=prefix)
+        os.replace(path, path + '.migrated')
+        return len(prefixes)
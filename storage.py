@@ -0,0 +1,628 @@
+'''
+storage.py keeps the user level records (user id, guild id, xp and level)
+and the xp history (xp gained per user per hour, rolled up into days)
+behind one small interface, so the cogs don't care where they are stored:
+    PostgresLevelRepository - the levelDB users table, through asyncpg
+    SQLiteLevelRepository   - an embedded SQLite file in WAL mode, for small
+                              deployments without a Postgres server
+Which one the bot uses comes from data/config.json (see load_config).
+Both can stream the users table to and from CSV (and Postgres its binary COPY format),
+for moving guilds between deployments (see levels_io.py).
+'''
+
+import asyncio
+import concurrent.futures
+import csv
+import json
+import os
+import sqlite3
+
+FILE_PATH = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(FILE_PATH, 'data', 'config.json')
+DEFAULT_CONFIG = {
+    'level_backend': 'postgres',    # or 'sqlite' for an embedded database file
+    'sqlite_path': os.path.join(FILE_PATH, 'data', 'levels.db'),
+    'postgres': {'database': 'levelDB', 'user': 'postgres', 'password': 'password'}
+}
+USER_COLUMNS = ('user_id', 'guild_id', 'xp', 'level')  # The columns exported, in this order
+IMPORT_BATCH = 1000     # Rows SQLite inserts per executemany while importing
+PURGE_TABLES = ('users', 'xp_hourly', 'xp_daily')   # The tables holding a guild's level data
+PURGE_BATCH = 500       # Rows deleted per statement, so a purge never locks a table for long
+READY_TIMEOUT = 60      # Seconds a command waits for the database to open before giving up
+
+class DatabaseUnavailable(Exception):
+    '''Raised when the database isn't open within READY_TIMEOUT'''
+
+async def wait_until_open(bot, timeout=READY_TIMEOUT):
+    '''Waits for r_bot.create_db_pool to open the database, raising DatabaseUnavailable if it doesn't in time'''
+    try:
+        await asyncio.wait_for(bot.db_ready.wait(), timeout)
+    except asyncio.TimeoutError:
+        raise DatabaseUnavailable('The database is not available, try again later') from None
+
+def load_config(path=CONFIG_FILE):
+    '''Reads data/config.json over the defaults; the file is optional'''
+    config = dict(DEFAULT_CONFIG)
+    if os.path.exists(path):
+        with open(path, 'r') as _f:
+            config.update(json.load(_f))
+    return config
+
+async def open_levels(config):
+    '''Opens the level store chosen in the config; returns (asyncpg pool or None, repository)'''
+    if config['level_backend'] == 'sqlite':
+        return None, SQLiteLevelRepository(config['sqlite_path'])
+    import asyncpg
+    pool = await asyncpg.create_pool(**config['postgres'])
+    return pool, PostgresLevelRepository(pool)
+
+class LevelRepository:
+    '''The operations the cogs need on the level records'''
+
+    async def get_user(self, user_id, guild_id):
+        '''Returns the user's record as a dict, creating it if it doesn't exist'''
+        raise NotImplementedError
+
+    async def add_xp(self, user_id, guild_id, amount):
+        '''Adds amount xp to the user and returns the updated record'''
+        raise NotImplementedError
+
+    async def set_level(self, user_id, guild_id, level):
+        raise NotImplementedError
+
+    async def prepare(self):
+        '''Creates the xp history tables if they don't exist yet'''
+
+    async def record_activity(self, rows):
+        '''Adds (guild id, user id, hour, xp) rows to the hourly xp buckets, in one batch'''
+        raise NotImplementedError
+
+    async def rollup(self, before):
+        '''Sums the hourly buckets older than before (unix time) into daily buckets and deletes them'''
+        raise NotImplementedError
+
+    async def prune(self, before):
+        '''Deletes the daily buckets older than before (unix time)'''
+        raise NotImplementedError
+
+    async def leaderboard(self, guild_id, since, limit):
+        '''Returns (user id, xp) of the members who gained the most xp since the given unix time'''
+        raise NotImplementedError
+
+    async def export_users(self, path, guild_id=None, format='csv'):
+        '''Streams the users of one guild (or all of them) to a file; returns the rows written'''
+        raise NotImplementedError
+
+    async def guild_ids(self):
+        '''Returns the set of guild ids that have level data'''
+        raise NotImplementedError
+
+    async def purge_guild(self, guild_id, batch=PURGE_BATCH):
+        '''Deletes all of a guild's level data, batch rows at a time; returns the rows deleted'''
+        raise NotImplementedError
+
+    async def import_users(self, path, guild_id=None, format='csv'):
+        """
+        Streams users from a file into the table, only taking one guild's if guild_id is given.
+        Imported rows replace the xp and level of existing ones, so importing twice changes nothing.
+        Returns the rows imported
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+ACTIVITY_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS xp_hourly (
+        guild_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        hour BIGINT NOT NULL,
+        xp INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, user_id, hour)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS xp_daily (
+        guild_id BIGINT NOT NULL,
+        user_id BIGINT NOT NULL,
+        day BIGINT NOT NULL,
+        xp INTEGER NOT NULL,
+        PRIMARY KEY (guild_id, user_id, day)
+    )
+    """
+)   # hour and day are the unix time the bucket starts at
+USERS_GUILD_INDEX = 'CREATE INDEX {} IF NOT EXISTS users_guild_id ON users (guild_id)'
+# users is keyed (user_id, guild_id), so without it every purge_guild batch would scan the whole table
+
+class PostgresLevelRepository(LevelRepository):
+    '''The users table of levelDB, every call a round trip to the Postgres server'''
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def get_user(self, user_id, guild_id):
+        user = await self.pool.fetchrow(
+            """
+            SELECT *
+            FROM users
+            WHERE user_id = $1 AND guild_id = $2
+            """,
+            user_id, guild_id
+        )
+        if not user:
+            user = await self.pool.fetchrow(
+                """
+                INSERT INTO users (user_id, guild_id)
+                VALUES ($1, $2)
+                RETURNING *
+                """,
+                user_id, guild_id
+            )
+        return dict(user)
+
+    async def add_xp(self, user_id, guild_id, amount):
+        user = await self.pool.fetchrow(
+            """
+            UPDATE users
+            SET xp = xp + $1
+            WHERE user_id = $2 AND guild_id = $3
+            RETURNING *
+            """,
+            amount, user_id, guild_id
+        )   # One round trip for members who already have a record
+        if user:
+            return dict(user)
+
+        await self.get_user(user_id, guild_id)
+        return await self.add_xp(user_id, guild_id, amount)
+
+    async def set_level(self, user_id, guild_id, level):
+        await self.pool.execute(
+            """
+            UPDATE users
+            SET level = $1
+            WHERE user_id = $2 AND guild_id = $3
+            """,
+            level, user_id, guild_id
+        )
+
+    async def prepare(self):
+        for statement in ACTIVITY_SCHEMA:
+            await self.pool.execute(statement)
+        await self.pool.execute(USERS_GUILD_INDEX.format('CONCURRENTLY'))
+        # Built without locking out the writes to users
+
+    async def record_activity(self, rows):
+        await self.pool.executemany(
+            """
+            INSERT INTO xp_hourly (guild_id, user_id, hour, xp)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (guild_id, user_id, hour) DO UPDATE SET xp = xp_hourly.xp + EXCLUDED.xp
+            """,
+            rows
+        )
+
+    async def rollup(self, before):
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await con.execute(
+                    """
+                    INSERT INTO xp_daily (guild_id, user_id, day, xp)
+                    SELECT guild_id, user_id, hour - hour % 86400, SUM(xp)
+                    FROM xp_hourly
+                    WHERE hour < $1
+                    GROUP BY guild_id, user_id, hour - hour % 86400
+                    ON CONFLICT (guild_id, user_id, day) DO UPDATE SET xp = xp_daily.xp + EXCLUDED.xp
+                    """,
+                    before
+                )
+                await con.execute('DELETE FROM xp_hourly WHERE hour < $1', before)
+
+    async def prune(self, before):
+        await self.pool.execute('DELETE FROM xp_daily WHERE day < $1', before)
+
+    async def leaderboard(self, guild_id, since, limit):
+        rows = await self.pool.fetch(
+            """
+            SELECT user_id, SUM(xp) AS xp
+            FROM (
+                SELECT user_id, xp FROM xp_hourly WHERE guild_id = $1 AND hour >= $2
+                UNION ALL
+                SELECT user_id, xp FROM xp_daily WHERE guild_id = $1 AND day >= $2
+            ) AS buckets
+            GROUP BY user_id
+            ORDER BY xp DESC
+            LIMIT $3
+            """,
+            guild_id, since, limit
+        )
+        return [(row['user_id'], row['xp']) for row in rows]
+
+    async def guild_ids(self):
+        rows = await self.pool.fetch(' UNION '.join(f'SELECT guild_id FROM {table}' for table in PURGE_TABLES))
+        return {row['guild_id'] for row in rows}
+
+    async def purge_guild(self, guild_id, batch=PURGE_BATCH):
+        deleted = 0
+        for table in PURGE_TABLES:
+            while True:
+                status = await self.pool.execute(
+                    f"""
+                    DELETE FROM {table}
+                    WHERE ctid IN (SELECT ctid FROM {table} WHERE guild_id = $1 LIMIT $2)
+                    """,
+                    guild_id, batch
+                )   # Each batch is its own short transaction
+                count = int(status.split()[-1])
+                deleted += count
+                if count < batch:
+                    break
+        return deleted
+
+    async def export_users(self, path, guild_id=None, format='csv'):
+        query = f"SELECT {', '.join(USER_COLUMNS)} FROM users"
+        args = ()
+        if guild_id is not None:
+            query += ' WHERE guild_id = $1'
+            args = (guild_id,)
+        async with self.pool.acquire() as con:
+            status = await con.copy_from_query(
+                query, *args, output=path, format=format, header=True if format == 'csv' else None)
+        # COPY writes straight into the file as the server sends it, so memory stays flat
+        return int(status.split()[-1])
+
+    async def import_users(self, path, guild_id=None, format='csv'):
+        async with self.pool.acquire() as con:
+            async with con.transaction():
+                await con.execute(
+                    """
+                    CREATE TEMP TABLE users_import (
+                        user_id BIGINT, guild_id BIGINT, xp INTEGER, level INTEGER,
+                        line BIGSERIAL
+                    ) ON COMMIT DROP
+                    """
+                )
+                await con.copy_to_table(
+                    'users_import', source=path, columns=USER_COLUMNS, format=format,
+                    header=True if format == 'csv' else None)
+                # Staged first, so the users table is changed by two set-based statements
+                # line numbers the rows in file order, so a member listed twice always
+                # gets their last row, as with SQLite's upserts
+                staged = """
+                    SELECT DISTINCT ON (user_id, guild_id) user_id, guild_id, xp, level
+                    FROM users_import
+                    WHERE $1::BIGINT IS NULL OR guild_id = $1
+                    ORDER BY user_id, guild_id, line DESC
+                    """
+                updated = await con.execute(
+                    f"""
+                    UPDATE users SET xp = staged.xp, level = staged.level
+                    FROM ({staged}) AS staged
+                    WHERE users.user_id = staged.user_id AND users.guild_id = staged.guild_id
+                    """,
+                    guild_id
+                )
+                inserted = await con.execute(
+                    f"""
+                    INSERT INTO users (user_id, guild_id, xp, level)
+                    SELECT * FROM ({staged}) AS staged
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM users
+                        WHERE users.user_id = staged.user_id AND users.guild_id = staged.guild_id
+                    )
+                    """,
+                    guild_id
+                )
+        return int(updated.split()[-1]) + int(inserted.split()[-1])
+
+    async def close(self):
+        await self.pool.close()
+
+class SQLiteLevelRepository(LevelRepository):
+    '''
+    An embedded SQLite database in WAL mode.
+    Reads are answered straight away in the bot's process from a reader connection
+    (WAL lets it read while a write is going on); writes are queued to a single
+    writer thread, so the event loop never waits for a disk sync.
+    '''
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER NOT NULL,
+            guild_id INTEGER NOT NULL,
+            xp INTEGER NOT NULL DEFAULT 0,
+            level INTEGER NOT NULL DEFAULT 1,
+            PRIMARY KEY (user_id, guild_id)
+        )
+        """
+
+    def __init__(self, path):
+        self.path = path
+        self.writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+        self.write_con = self.connect()
+        self.write_con.execute('PRAGMA journal_mode=WAL')
+        self.write_con.execute('PRAGMA synchronous=NORMAL')
+        self.write_con.execute(self.SCHEMA)
+        for statement in ACTIVITY_SCHEMA:
+            self.write_con.execute(statement)
+        self.read_con = self.connect()
+
+    async def prepare(self):
+        await self.write(lambda con: con.execute(USERS_GUILD_INDEX.format('')))
+
+    def connect(self):
+        con = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        con.row_factory = sqlite3.Row
+        return con
+
+    async def write(self, func, *args):
+        '''Runs func(connection, *args) on the writer thread'''
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.writer, func, self.write_con, *args)
+
+    def read_user(self, user_id, guild_id):
+        row = self.read_con.execute(
+            'SELECT * FROM users WHERE user_id = ? AND guild_id = ?', (user_id, guild_id)
+        ).fetchone()
+        return dict(row) if row else None
+
+    @staticmethod
+    def _insert(con, user_id, guild_id):
+        con.execute('INSERT OR IGNORE INTO users (user_id, guild_id) VALUES (?, ?)', (user_id, guild_id))
+
+    @staticmethod
+    def _add_xp(con, user_id, guild_id, amount):
+        con.execute('BEGIN')
+        try:
+            con.execute('INSERT OR IGNORE INTO users (user_id, guild_id) VALUES (?, ?)', (user_id, guild_id))
+            con.execute('UPDATE users SET xp = xp + ? WHERE user_id = ? AND guild_id = ?', (amount, user_id, guild_id))
+            row = con.execute('SELECT * FROM users WHERE user_id = ? AND guild_id = ?', (user_id, guild_id)).fetchone()
+            con.execute('COMMIT')
+        except Exception:
+            if con.in_transaction:
+                con.execute('ROLLBACK')     # Otherwise the writer connection stays in the failed transaction
+            raise
+        return dict(row)
+
+    @staticmethod
+    def _set_level(con, user_id, guild_id, level):
+        con.execute('UPDATE users SET level = ? WHERE user_id = ? AND guild_id = ?', (level, user_id, guild_id))
+
+    async def get_user(self, user_id, guild_id):
+        user = self.read_user(user_id, guild_id)
+        if user:
+            return user
+        await self.write(self._insert, user_id, guild_id)
+        return self.read_user(user_id, guild_id)
+
+    async def add_xp(self, user_id, guild_id, amount):
+        return await self.write(self._add_xp, user_id, guild_id, amount)
+
+    async def set_level(self, user_id, guild_id, level):
+        await self.write(self._set_level, user_id, guild_id, level)
+
+    @staticmethod
+    def _record_activity(con, rows):
+        con.execute('BEGIN')
+        try:
+            con.executemany(
+                """
+                INSERT INTO xp_hourly (guild_id, user_id, hour, xp) VALUES (?, ?, ?, ?)
+                ON CONFLICT (guild_id, user_id, hour) DO UPDATE SET xp = xp + excluded.xp
+                """,
+                rows
+            )
+            con.execute('COMMIT')
+        except Exception:
+            if con.in_transaction:
+                con.execute('ROLLBACK')
+            raise
+
+    @staticmethod
+    def _rollup(con, before):
+        con.execute('BEGIN')
+        try:
+            con.execute(
+                """
+                INSERT INTO xp_daily (guild_id, user_id, day, xp)
+                SELECT guild_id, user_id, hour - hour % 86400, SUM(xp)
+                FROM xp_hourly
+                WHERE hour < ?
+                GROUP BY guild_id, user_id, hour - hour % 86400
+                ON CONFLICT (guild_id, user_id, day) DO UPDATE SET xp = xp + excluded.xp
+                """,
+                (before,)
+            )
+            con.execute('DELETE FROM xp_hourly WHERE hour < ?', (before,))
+            con.execute('COMMIT')
+        except Exception:
+            if con.in_transaction:
+                con.execute('ROLLBACK')
+            raise
+
+    async def record_activity(self, rows):
+        await self.write(self._record_activity, rows)
+
+    async def rollup(self, before):
+        await self.write(self._rollup, before)
+
+    async def prune(self, before):
+        await self.write(lambda con: con.execute('DELETE FROM xp_daily WHERE day < ?', (before,)))
+
+    async def leaderboard(self, guild_id, since, limit):
+        rows = self.read_con.execute(
+            """
+            SELECT user_id, SUM(xp) AS xp
+            FROM (
+                SELECT user_id, xp FROM xp_hourly WHERE guild_id = ? AND hour >= ?
+                UNION ALL
+                SELECT user_id, xp FROM xp_daily WHERE guild_id = ? AND day >= ?
+            )
+            GROUP BY user_id
+            ORDER BY xp DESC
+            LIMIT ?
+            """,
+            (guild_id, since, guild_id, since, limit)
+        ).fetchall()
+        return [(row['user_id'], row['xp']) for row in rows]
+
+    UPSERT = """
+        INSERT INTO users (user_id, guild_id, xp, level) VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, guild_id) DO UPDATE SET xp = excluded.xp, level = excluded.level
+        """
+
+    @staticmethod
+    def _export_users(con, path, guild_id):
+        query = f"SELECT {', '.join(USER_COLUMNS)} FROM users"
+        rows = con.execute(query + ' WHERE guild_id = ?', (guild_id,)) if guild_id is not None else con.execute(query)
+        count = 0
+        with open(path, 'w', newline='') as _f:
+            writer = csv.writer(_f)
+            writer.writerow(USER_COLUMNS)
+            for row in rows:    # The cursor hands the rows over one at a time
+                writer.writerow(tuple(row))
+                count += 1
+        return count
+
+    @staticmethod
+    def _import_users(con, path, guild_id):
+        count = 0
+        with open(path, 'r', newline='') as _f:
+            reader = csv.reader(_f)
+            header = next(reader, None)
+            if header is None:
+                return 0
+            positions = [header.index(column) for column in USER_COLUMNS]
+            con.execute('BEGIN')
+            try:
+                batch = []
+                for record in reader:
+                    row = tuple(int(record[i]) for i in positions)
+                    if guild_id is not None and row[1] != guild_id:
+                        continue
+                    batch.append(row)
+                    if len(batch) >= IMPORT_BATCH:
+                        con.executemany(SQLiteLevelRepository.UPSERT, batch)
+                        count += len(batch)
+                        batch = []
+                con.executemany(SQLiteLevelRepository.UPSERT, batch)
+                count += len(batch)
+                con.execute('COMMIT')
+            except Exception:
+                con.execute('ROLLBACK')
+                raise
+        return count
+
+    async def guild_ids(self):
+        rows = self.read_con.execute(' UNION '.join(f'SELECT guild_id FROM {table}' for table in PURGE_TABLES))
+        return {row['guild_id'] for row in rows}
+
+    async def purge_guild(self, guild_id, batch=PURGE_BATCH):
+        deleted = 0
+        for table in PURGE_TABLES:
+            while True:
+                count = await self.write(lambda con: con.execute(
+                    f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE guild_id = ? LIMIT ?)',
+                    (guild_id, batch)
+                ).rowcount)     # Other writes get the writer thread between batches
+                deleted += count
+                if count < batch:
+                    break
+        return deleted
+
+    async def export_users(self, path, guild_id=None, format='csv'):
+        if format != 'csv':
+            raise ValueError('SQLite only exports csv')
+        return await self.write(self._export_users, path, guild_id)
+        # Run on the writer thread, so a big export never holds up the event loop
+
+    async def import_users(self, path, guild_id=None, format='csv'):
+        if format != 'csv':
+            raise ValueError('SQLite only imports csv')
+        return await self.write(self._import_users, path, guild_id)
+
+    async def close(self):
+        await self.write(lambda con: con.close())
+        self.read_con.close()
+        self.writer.shutdown()
+
+class PostgresSettingsRepository:
+    '''Per-guild settings in the guild_settings table, one row per changed setting'''
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS guild_settings (
+            guild_id BIGINT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (guild_id, key)
+        )
+        """
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def load_all(self):
+        '''Returns every stored setting as (guild id, key, json value) rows'''
+        await self.pool.execute(self.SCHEMA)
+        rows = await self.pool.fetch('SELECT guild_id, key, value FROM guild_settings')
+        return [(row['guild_id'], row['key'], row['value']) for row in rows]
+
+    async def save(self, guild_id, key, value):
+        await self.pool.execute(
+            """
+            INSERT INTO guild_settings (guild_id, key, value)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (guild_id, key) DO UPDATE SET value = EXCLUDED.value
+            """,
+            guild_id, key, value
+        )
+
+    async def delete(self, guild_id, key):
+        await self.pool.execute(
+            'DELETE FROM guild_settings WHERE guild_id = $1 AND key = $2', guild_id, key
+        )
+
+    async def guild_ids(self):
+        rows = await self.pool.fetch('SELECT DISTINCT guild_id FROM guild_settings')
+        return {row['guild_id'] for row in rows}
+
+    async def delete_guild(self, guild_id):
+        '''Deletes every setting of a guild (a handful of rows at most); returns the rows deleted'''
+        status = await self.pool.execute('DELETE FROM guild_settings WHERE guild_id = $1', guild_id)
+        return int(status.split()[-1])
+
+class SQLiteSettingsRepository:
+    '''Per-guild settings in the same embedded SQLite file as the levels'''
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS guild_settings (
+            guild_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (guild_id, key)
+        )
+        """
+
+    def __init__(self, levels):
+        self.levels = levels    # Shares the SQLiteLevelRepository's connections and writer thread
+        self.levels.write_con.execute(self.SCHEMA)
+
+    async def load_all(self):
+        return self.levels.read_con.execute('SELECT guild_id, key, value FROM guild_settings').fetchall()
+
+    async def save(self, guild_id, key, value):
+        await self.levels.write(
+            lambda con: con.execute('INSERT OR REPLACE INTO guild_settings VALUES (?, ?, ?)', (guild_id, key, value)))
+
+    async def delete(self, guild_id, key):
+        await self.levels.write(
+            lambda con: con.execute('DELETE FROM guild_settings WHERE guild_id = ? AND key = ?', (guild_id, key)))
+
+    async def guild_ids(self):
+        rows = self.levels.read_con.execute('SELECT DISTINCT guild_id FROM guild_settings')
+        return {row['guild_id'] for row in rows}
+
+    async def delete_guild(self, guild_id):
+        return await self.levels.write(
+            lambda con: con.execute('DELETE FROM guild_settings WHERE guild_id = ?', (guild_id,)).rowcount)
@@ -0,0 +1,470 @@
+'''
+voice_worker.py moves audio work out of the bot's process.
+Reading a track through FFmpeg, changing its volume and encoding it to Opus
+all happen in a pool of worker processes; the bot only receives ready-made
+Opus packets, which the voice client sends without decoding anything.
+That way a guild with a heavy playlist can't hold the GIL while
+the bot should be answering the gateway or handling messages.
+
+Short clips (the soundboard) are decoded once to raw PCM files and memory-mapped
+by the workers, so playing one, or mixing it over the music with overlay,
+costs neither an FFmpeg process nor a decode.
+
+The bot and a worker talk over a multiprocessing Pipe with small tuples:
+    bot -> worker: (op, session id, arguments), op being one of
+        play, pause, resume, volume, seek, status, credit, overlay, stop,
+        and unload_clip (with no session) to unmap a removed clip
+    worker -> bot:
+        ('frames', session id, generation, [opus packets])
+        ('status', session id, request id, {...}), answering ('status', session id, request id)
+        ('end', session id, generation, error or None)
+A worker only sends as many frames as the bot has given it credit for,
+so each session never buffers more than WINDOW frames (about a second).
+'''
+
+import asyncio
+import audioop
+import concurrent.futures
+import itertools
+import mmap
+import multiprocessing
+import os
+import subprocess
+import threading
+from collections import deque
+
+import discord
+
+try:
+    import numpy
+except ImportError:     # Overlays are mixed with audioop instead
+    numpy = None
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FRAME_SAMPLES = 960                     # 20ms of audio per Opus packet
+FRAME_SIZE = FRAME_SAMPLES * CHANNELS * 2   # Bytes of 16 bit PCM in one frame
+FRAME_LENGTH = 0.02                     # Seconds per frame
+WINDOW = 50         # Frames a session may have in flight before the bot asks for more
+CREDIT_EVERY = 10   # The bot grants credit after reading this many frames
+BATCH = 5           # Frames sent to the bot per message
+UNDERRUN_TIMEOUT = 5    # Seconds read() waits for a frame before giving up on the session
+STATUS_TIMEOUT = 5      # Seconds status() waits for the worker's answer
+WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+STREAM_OPTIONS = ['-reconnect', '1', '-reconnect_streamed', '1', '-reconnect_delay_max', '5']
+MAX_OVERLAYS = 4    # Clips mixed over one session at once; more are dropped
+
+# ------------------------- Worker process -------------------------
+
+CLIPS = {}  # path -> mmap of a pre-decoded clip, shared by every session of the worker
+
+def load_clip(path):
+    '''Maps a raw PCM clip once; the OS page cache shares it between the workers'''
+    clip = CLIPS.get(path)
+    if clip is None:
+        with open(path, 'rb') as _f:
+            clip = CLIPS[path] = mmap.mmap(_f.fileno(), 0, access=mmap.ACCESS_READ)
+    return clip
+
+def unload_clip(path):
+    '''Forgets a clip; sessions still playing it keep their mapping until they finish'''
+    CLIPS.pop(path, None)
+
+def mix(pcm, other):
+    '''Adds two frames of 16 bit PCM, clipping instead of wrapping around'''
+    if numpy is not None:
+        mixed = numpy.frombuffer(pcm, numpy.int16).astype(numpy.int32)
+        mixed += numpy.frombuffer(other, numpy.int16)
+        return numpy.clip(mixed, -32768, 32767).astype(numpy.int16).tobytes()
+    return audioop.add(pcm, other, 2)
+
+class ClipReader:
+    '''Reads a mapped clip like FFmpeg's stdout, starting at a byte offset'''
+
+    def __init__(self, clip, offset=0):
+        self.clip = clip
+        self.offset = offset
+
+    def read(self, size):
+        data = self.clip[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+class Overlay:
+    '''A clip being mixed over a session, and how far it has got'''
+    __slots__ = ('clip', 'offset')
+
+    def __init__(self, clip):
+        self.clip = clip
+        self.offset = 0
+
+    def next_frame(self):
+        '''The next frame of the clip, padded with silence at the end, or None once it's over'''
+        if self.offset >= len(self.clip):
+            return None
+        frame = self.clip[self.offset:self.offset + FRAME_SIZE]
+        self.offset += FRAME_SIZE
+        return frame.ljust(FRAME_SIZE, b'\0')
+
+class Playback(threading.Thread):
+    '''Decodes and encodes one session inside a worker process'''
+
+    def __init__(self, sid, conn, send_lock, source, volume, seek=0, stream=False, raw=False):
+        super().__init__(daemon=True)
+        self.sid = sid
+        self.conn = conn
+        self.send_lock = send_lock
+        self.source = source
+        self.volume = volume
+        self.stream = stream
+        self.raw = raw      # source is a pre-decoded clip, read straight from memory
+        self.seek_to = seek
+        self.generation = 0
+        self.credits = WINDOW
+        self.paused = False
+        self.stopped = False
+        self.frames_sent = 0
+        self.process = None
+        self.reader = None
+        self.overlays = []  # Clips queued by the bot, picked up by the playback loop
+        self.changed = threading.Condition()
+
+    def send(self, message):
+        with self.send_lock:
+            self.conn.send(message)
+
+    def open(self):
+        '''Starts FFmpeg at seek_to, seeking the input so it doesn't decode from the start'''
+        if self.process:
+            self.process.kill()
+        if self.raw:
+            offset = int(self.seek_to / FRAME_LENGTH) * FRAME_SIZE
+            self.reader = ClipReader(load_clip(self.source), offset)
+            return
+        args = ['ffmpeg', '-nostdin', '-loglevel', 'error']
+        if self.stream:
+            args += STREAM_OPTIONS
+        if self.seek_to:
+            args += ['-ss', str(self.seek_to)]
+        args += ['-i', self.source, '-vn', '-f', 's16le', '-ar', str(SAMPLE_RATE),
+                 '-ac', str(CHANNELS), 'pipe:1']
+        self.process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        self.reader = self.process.stdout
+
+    def control(self, op, args):
+        '''Applies a control message from the bot'''
+        with self.changed:
+            if op == 'credit':
+                self.credits += args
+            elif op == 'pause':
+                self.paused = True
+            elif op == 'resume':
+                self.paused = False
+            elif op == 'volume':
+                self.volume = args
+            elif op == 'overlay':
+                try:
+                    self.overlays.append(Overlay(load_clip(args)))
+                except (OSError, ValueError):
+                    pass    # The clip was removed (or is empty)
+            elif op == 'seek':
+                self.seek_to = args
+                self.generation += 1
+                self.credits = WINDOW   # The bot throws away everything it had buffered
+            elif op == 'stop':
+                self.stopped = True
+            self.changed.notify()
+
+    def status(self):
+        return {'frames_sent': self.frames_sent, 'paused': self.paused,
+                'volume': self.volume, 'source': self.source}
+
+    def run(self):
+        encoder = discord.opus.Encoder()
+        error = None
+        generation = -1
+        batch = []
+        overlays = []
+        try:
+            while True:
+                with self.changed:
+                    while not self.stopped and (self.paused or self.credits <= 0) \
+                            and generation == self.generation:
+                        self.changed.wait()
+                    if self.stopped:
+                        break
+                    if generation != self.generation:
+                        generation = self.generation
+                        batch = []
+                        self.open()
+                        continue    # Waits again in case the session is paused
+                    self.credits -= 1
+                    volume = self.volume
+                    if self.overlays:
+                        overlays = (overlays + self.overlays)[-MAX_OVERLAYS:]
+                        self.overlays = []
+
+                pcm = self.reader.read(FRAME_SIZE)
+                if len(pcm) < FRAME_SIZE:
+                    break   # End of the track
+                if volume != 1:
+                    pcm = audioop.mul(pcm, 2, min(volume, 2.0))
+                for overlay in overlays:
+                    frame = overlay.next_frame()
+                    if frame:
+                        pcm = mix(pcm, frame)
+                overlays = [overlay for overlay in overlays if overlay.offset < len(overlay.clip)]
+                batch.append(encoder.encode(pcm, FRAME_SAMPLES))
+                self.frames_sent += 1
+
+                if len(batch) >= BATCH:
+                    self.send(('frames', self.sid, generation, batch))
+                    batch = []
+            if batch and not self.stopped:
+                self.send(('frames', self.sid, generation, batch))
+        except Exception as _e:   # Reported to the bot, which shows it in the text channel
+            error = f'{type(_e).__name__}: {_e}'
+        finally:
+            if self.process:
+                self.process.kill()
+            if not self.stopped:
+                self.send(('end', self.sid, generation, error))
+
+def worker_main(conn):
+    '''Entry point of a worker process: runs a playback thread per session'''
+    send_lock = threading.Lock()
+    sessions = {}
+
+    while True:
+        try:
+            op, sid, args = conn.recv()
+        except (EOFError, OSError):
+            break   # The bot went away
+
+        if op == 'unload_clip':
+            unload_clip(args)
+            continue
+        if op == 'play':
+            playback = Playback(sid, conn, send_lock, **args)
+            sessions[sid] = playback
+            playback.start()
+            continue
+
+        playback = sessions.get(sid)
+        if not playback:
+            continue
+        if op == 'status':
+            with send_lock:
+                conn.send(('status', sid, args, playback.status()))   # args is the request id
+        else:
+            playback.control(op, args)
+            if op == 'stop':
+                del sessions[sid]
+
+    for playback in sessions.values():
+        playback.control('stop', None)
+
+# ------------------------- Bot process -------------------------
+
+class WorkerSession(discord.AudioSource):
+    '''
+    An Opus audio source whose packets are made by a worker process.
+    read() runs in the voice client's player thread, so it may block.
+    '''
+
+    def __init__(self, worker, sid, volume, start=0):
+        self.worker = worker
+        self.sid = sid
+        self._volume = volume
+        self.start = start      # Seconds into the track the worker started (or last seeked) at
+        self.frames_read = 0    # Frames the voice client has taken since then
+        self.frames = deque()
+        self.generation = 0
+        self.ended = False
+        self.error = None
+        self.unacked = 0
+        self.arrived = threading.Condition()
+        self.status_futures = {}    # request id -> Future of the worker's answer
+        self.status_ids = itertools.count()
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        with self.arrived:
+            if not self.frames and not self.ended:
+                self.arrived.wait_for(lambda: self.frames or self.ended, UNDERRUN_TIMEOUT)
+            if not self.frames:
+                return b''  # Ends the playback
+            packet = self.frames.popleft()
+            self.frames_read += 1
+
+        self.unacked += 1
+        if self.unacked >= CREDIT_EVERY:
+            self.worker.send('credit', self.sid, self.unacked)
+            self.unacked = 0
+        return packet
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = value
+        self.worker.send('volume', self.sid, value)
+
+    def pause(self):
+        self.worker.send('pause', self.sid)
+
+    def resume(self):
+        self.worker.send('resume', self.sid)
+
+    def overlay(self, path):
+        '''Mixes a pre-decoded clip (see load_clip) over whatever this session is playing'''
+        self.worker.send('overlay', self.sid, path)
+
+    @property
+    def position(self):
+        '''Seconds into the track of the frame the voice client read last'''
+        return self.start + self.frames_read * FRAME_LENGTH
+
+    def seek(self, position):
+        '''Restarts the track at position seconds, dropping the frames already buffered'''
+        with self.arrived:
+            self.generation += 1
+            self.start = position
+            self.frames_read = 0
+            self.frames.clear()
+            self.ended = False
+            self.unacked = 0
+        self.worker.send('seek', self.sid, position)
+
+    async def status(self, timeout=STATUS_TIMEOUT):
+        '''
+        Asks the worker how far it has got.
+        Each request has its own id, so concurrent calls each get their answer;
+        raises asyncio.TimeoutError if the worker doesn't answer (e.g. it died)
+        '''
+        request = next(self.status_ids)
+        future = self.status_futures[request] = concurrent.futures.Future()
+        self.worker.send('status', self.sid, request)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+        finally:
+            self.status_futures.pop(request, None)
+
+    def cleanup(self):
+        self.worker.send('stop', self.sid)
+        self.worker.sessions.pop(self.sid, None)
+
+    # Called by the worker's reader thread
+
+    def feed(self, generation, packets):
+        with self.arrived:
+            if generation == self.generation:
+                self.frames.extend(packets)
+                self.arrived.notify()
+
+    def finish(self, generation, error):
+        with self.arrived:
+            if generation == self.generation:
+                self.ended = True
+                self.error = error
+                self.arrived.notify()
+
+class Worker:
+    '''The bot's side of one worker process'''
+
+    def __init__(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.sessions = {}
+        self.send_lock = threading.Lock()
+        self.reader = threading.Thread(target=self.read_loop, daemon=True)
+        self.reader.start()
+
+    def send(self, op, sid, args=None):
+        with self.send_lock:
+            try:
+                self.conn.send((op, sid, args))
+            except (BrokenPipeError, OSError):
+                pass    # The worker died; its sessions end through read_loop
+
+    def read_loop(self):
+        '''Hands the frames and replies from the worker to their sessions'''
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            session = self.sessions.get(message[1])
+            if not session:
+                continue
+            if message[0] == 'frames':
+                session.feed(message[2], message[3])
+            elif message[0] == 'end':
+                session.finish(message[2], message[3])
+            elif message[0] == 'status':
+                future = session.status_futures.get(message[2])
+                if future and not future.done():
+                    try:
+                        future.set_result(message[3])
+                    except concurrent.futures.InvalidStateError:
+                        pass    # Timed out on the event loop at the same moment
+
+        for session in list(self.sessions.values()):
+            session.finish(session.generation, 'The voice worker stopped')
+
+    def close(self):
+        self.conn.close()
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+class VoicePool:
+    '''A fixed pool of worker processes, each new session going to the least busy one'''
+
+    def __init__(self, size=WORKERS):
+        self.size = size
+        self.workers = []
+        self.ids = itertools.count()
+
+    def open(self, source, volume=1.0, seek=0, stream=False, raw=False):
+        '''
+        Starts playing source in a worker and returns the session to give to a voice client.
+        With raw, source is a pre-decoded clip that is read from memory instead of through FFmpeg
+        '''
+        self.workers = [worker for worker in self.workers if worker.process.is_alive()]
+        if len(self.workers) < self.size:
+            self.workers.append(Worker())   # Workers start on first use, and again if one died
+        worker = min(self.workers, key=lambda w: len(w.sessions))
+
+        sid = next(self.ids)
+        session = WorkerSession(worker, sid, volume, start=seek)
+        worker.sessions[sid] = session
+        worker.send('play', sid, {'source': source, 'volume': volume, 'seek': seek,
+                                     'stream': stream, 'raw': raw})
+        return session
+
+    def unload_clip(self, path):
+        '''Has every worker forget a clip, so its file is unmapped once nothing plays it'''
+        for worker in self.workers:
+            worker.send('unload_clip', None, path)
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+
+_POOL = None
+
+def get_pool():
+    '''The pool shared by every cog that plays audio in this process'''
+    global _POOL
+    if _POOL is None:
+        _POOL = VoicePool()
+    return _POOL